@@ -1,142 +1,362 @@
 import os
 import json
-import base64
 import time
 import traceback
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
-from openai import OpenAI
-import requests
-from bs4 import BeautifulSoup
+from concurrent.futures import Future, ThreadPoolExecutor
+from document_index import DocumentIndex
+from image_preprocess import prepare_screenshot
+from llm_cache import LLMResponseCache
+from llm_client import ResilientLLMClient
+from metrics import ANALYSES_IN_FLIGHT, FALLBACK_RESULTS, JSON_PARSE_FAILURES, LLM_CALLS, STAGE_DURATION
+from page_loader import fetch_html, render_page, static_page, url_to_filename
+from render_detector import resolve_render_mode, should_render
+from page_state import PageStateStore, content_fingerprint, dom_fingerprint, stable_hash
+from result_store import ResultStore
+from screenshot_store import get_screenshot_store
+import tracing
 
 class CVRAnalyzer:
-    def __init__(self):
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    def __init__(self, concurrent=None, max_workers=None, use_cache=None, incremental=None):
+        # 期限・リトライ・遮断・ヘッジ付きでOpenAI APIを呼び出す（CVR_LLM_* で調整）
+        self.llm = ResilientLLMClient()
+        # 同一プロンプト・同一画像への応答を再利用するディスクキャッシュ（CVR_LLM_CACHE=0で無効）
+        self.cache = LLMResponseCache(enabled=use_cache)
+        # 依存関係のないステージ（取得・撮影・LLM呼び出し）を並行実行するかどうか
+        if concurrent is None:
+            concurrent = os.getenv("CVR_CONCURRENT", "1") != "0"
+        self.concurrent = concurrent
+        self.max_workers = max_workers or int(os.getenv("CVR_MAX_WORKERS", "6"))
+        # 変更のないページは前回の結果を再利用する（CVR_INCREMENTAL=0で無効）
+        if incremental is None:
+            incremental = os.getenv("CVR_INCREMENTAL", "1") != "0"
+        self.incremental = incremental
+        self.page_state = PageStateStore()
+        # 分析結果の履歴（IDで再表示・スコアの比較に使う）
+        self.results = ResultStore()
+        # combined: 全デバイスのスクリーンショットを1回のリクエストで分析する / separate: デバイスごとに分析する
+        self.vision_mode = os.getenv("CVR_VISION_MODE", "combined")
+        # まとめて分析したときに、応答が不正だったデバイスだけを問い合わせ直す回数
+        self.vision_retries = int(os.getenv("CVR_VISION_RETRIES", "1"))
+
+    @property
+    def client(self):
+        """OpenAIクライアント（最初に参照したときに作る）"""
+        return self.llm.client
 
     def capture_screenshot(self, url, device_type="desktop"):
         """指定されたURLのスクリーンショットを取得する"""
-        options = Options()
-        options.add_argument("--headless")
-
-        # デバイスタイプに基づいた設定
-        if device_type == "mobile":
-            options.add_argument("--window-size=375,812")
-            options.add_argument("user-agent=Mozilla/5.0 (iPhone; CPU iPhone OS 13_2_3 like Mac OS X)")
-        else:  # desktop
-            options.add_argument("--window-size=1920,1080")
-
-        # ChromeDriverの設定
-        service = Service(ChromeDriverManager().install())
-        driver = webdriver.Chrome(service=service, options=options)
-
-        try:
-            driver.get(url)
-            # ページが完全に読み込まれるのを待つ
-            driver.implicitly_wait(10)
-
-            # フルページスクリーンショットのための処理
-            total_height = driver.execute_script("return document.body.scrollHeight")
-            driver.set_window_size(driver.get_window_size()['width'], total_height)
-
-            # スクリーンショットの取得
-            screenshot = driver.get_screenshot_as_png()
-
-            # 保存パスの設定
-            timestamp = int(time.time())
-            filename = f"static/screenshots/{url_to_filename(url)}_{device_type}_{timestamp}.png"
-            os.makedirs(os.path.dirname(filename), exist_ok=True)
-
-            # ファイルに保存
-            with open(filename, "wb") as f:
-                f.write(screenshot)
-
-            return filename
-        finally:
-            driver.quit()
-
-    def analyze_website(self, url):
-        """ウェブサイトの包括的なCVR分析を実行"""
+        return render_page(url, devices=(device_type,)).screenshots[device_type]
+
+    def acquire_page(self, url, timings=None, prefetched=None, concurrent=True):
+        """URLを1回だけ取得・レンダリングし、全分析が共有する成果物一式を返す
+
+        生HTMLの取得とブラウザでのレンダリング・撮影は並行して行う（concurrent=False なら取得、
+        レンダリングの順に呼び出し元のスレッドで実行する）。
+        prefetched に取得済みの FetchResult を渡した場合は再取得しない。
+        """
+        timings = {} if timings is None else timings
+        if not concurrent:
+            if prefetched is None:
+                prefetched = self._run_stage(timings, "get_website_content", self.fetch_website_content, url)
+            page = self._run_stage(timings, "render_page", render_page, url)
+            page.fetch = prefetched
+            page.raw_html = prefetched.html
+            return page
+        with ThreadPoolExecutor(max_workers=2 if concurrent else 1) as executor:
+            fetch_future = None
+            if prefetched is None:
+                fetch_future = executor.submit(
+                    tracing.wrap(self._run_stage), timings, "get_website_content", self.fetch_website_content, url)
+            page = self._run_stage(timings, "render_page", render_page, url)
+            page.fetch = prefetched if fetch_future is None else fetch_future.result()
+            page.raw_html = page.fetch.html
+            return page
+
+    def analyze_website(self, url, concurrent=None, force=False, render_mode=None, on_event=None, trace=None,
+                        on_page=None):
+        """ウェブサイトの包括的なCVR分析を実行
+
+        前回の分析結果がある場合、ページが変更されていなければその結果を再利用する
+        （force=True で常に再分析）。
+        render_mode が "auto" ならJavaScriptでの描画が不要なページはブラウザを使わず、
+        "text" なら常にブラウザを使わずにテキスト分析だけを行う（省略時は CVR_RENDER_MODE）。
+        on_event(name, data) を渡すと、ページの取得や各ステージの出力を完了した順に通知する
+        （name はステージ名。ページ取得は "page"）。
+        trace=True なら処理の内訳をトレースとして data/traces に書き出す（省略時は CVR_TRACE）。
+        on_page(page) を渡すと、読み込んだページの PageArtifacts を分析の前に渡す
+        （304で前回の結果を再利用する場合は呼ばれない）。
+        """
+        with ANALYSES_IN_FLIGHT.track_inprogress(), tracing.start_trace("analyze_website", trace, url=url):
+            return self._analyze_website(url, concurrent, force, render_mode, on_event, on_page)
+
+    def _analyze_website(self, url, concurrent, force, render_mode, on_event, on_page):
         print(f"URLの分析を開始: {url}")
+        if concurrent is None:
+            concurrent = self.concurrent
+        render_mode = resolve_render_mode(render_mode)
 
-        # 1. コンテンツ取得
-        html_content = self.get_website_content(url)
-        print("HTMLコンテンツの取得完了")
-
-        # 2. スクリーンショット取得
-        desktop_screenshot = self.capture_screenshot(url, "desktop")
-        print(f"デスクトップスクリーンショット取得完了: {desktop_screenshot}")
-        mobile_screenshot = self.capture_screenshot(url, "mobile")
-        print(f"モバイルスクリーンショット取得完了: {mobile_screenshot}")
-
-        # 3. テキスト分析
-        text_analysis = self.analyze_content(html_content)
-        print("テキスト分析完了")
-
-        # 4. 視覚分析
-        visual_analysis_desktop = self.analyze_screenshot(desktop_screenshot, "desktop")
-        print("デスクトップビジュアル分析完了")
-        visual_analysis_mobile = self.analyze_screenshot(mobile_screenshot, "mobile")
-        print("モバイルビジュアル分析完了")
-
-        # 5. 総合分析
-        combined_analysis = self.combine_analyses(
-            text_analysis=text_analysis,
-            visual_desktop=visual_analysis_desktop,
-            visual_mobile=visual_analysis_mobile
-        )
-        print("総合分析完了")
+        def emit(name, data):
+            if on_event is None:
+                return
+            try:
+                on_event(name, data)
+            except Exception as e:
+                # 通知先のエラーで分析を止めない
+                print(f"イベント通知エラー ({name}): {str(e)}")
+
+        # ステージごとの実行時間（秒）
+        timings = {}
+        started_at = time.perf_counter()
+
+        prior = None
+        if self.incremental and not force:
+            prior = self.page_state.get(url)
+        # 前回と異なるモード（テキストのみ／ブラウザあり）の結果は、そのままでは再利用しない
+        reusable = prior is not None and render_mode in ("auto", prior["result"].get("render_mode", "full"))
+        # デフォルト値で補った部分がある結果は、ページが変わっていなくても再分析する
+        reusable = reusable and "fallback" not in prior["result"].get("sections", {}).values()
+
+        # 1. ページ取得
+        prefetched = None
+        needs_render = False
+        if reusable:
+            # 前回の結果がある場合は、まず条件付きリクエストで変更の有無を確かめる
+            prefetched = self._run_stage(
+                timings, "get_website_content", self.fetch_website_content,
+                url, prior["etag"], prior["last_modified"])
+            if prefetched.not_modified:
+                if prior["result"].get("render_mode") == "text":
+                    print("ページは前回の分析から変更されていません（304）")
+                    return self._reuse_result(url, prior, prefetched, timings, started_at, "not_modified")
+                # 前回ブラウザで描画したページは、HTMLが同じでもJavaScriptで取得する内容が変わりうるので、
+                # レンダリングしてからDOMの指紋で判断する
+                print("HTMLは前回の分析から変更されていません（304）。レンダリング後のDOMを比較します")
+                needs_render = True
+
+        page = None
+        if render_mode != "full" and not needs_render:
+            # 静的なHTMLだけで分析できるページはブラウザを起動しない
+            if prefetched is None:
+                prefetched = self._run_stage(timings, "get_website_content", self.fetch_website_content, url)
+            page = static_page(url, prefetched)
+            decision = should_render(render_mode, page.document)
+            if decision.needs_render:
+                print(f"ブラウザでレンダリングします: {', '.join(decision.reasons)}")
+                page = None
+            else:
+                print("ブラウザを使わずにテキストのみで分析します")
+        if page is None:
+            page = self.acquire_page(url, timings, prefetched, concurrent)
+        if on_page is not None:
+            on_page(page)
+        emit("page", {"screenshots": dict(page.screenshots), "render_mode": "full" if page.screenshots else "text"})
+
+        # レンダリング後のDOMと、各分析ステージの入力の指紋
+        fingerprint = dom_fingerprint(page.document)
+        stage_inputs = {"analyze_content": content_fingerprint(page.document)}
+        for device_type, screenshot_path in page.screenshots.items():
+            # スクリーンショットは内容のハッシュで保存されるので、パスが同じなら同じ画像
+            stage_inputs[f"analyze_screenshot_{device_type}"] = screenshot_path
+        if (reusable and prior["fingerprint"] == fingerprint and
+                prior["stages"].get("analyze_content", {}).get("input") == stage_inputs["analyze_content"]):
+            print("レンダリング後のDOMが前回の分析と一致しました")
+            if page.screenshots:
+                prior["result"]["screenshots"] = dict(page.screenshots)
+            return self._reuse_result(url, prior, page.fetch, timings, started_at, "fingerprint_match")
+
+        # 入力が前回と同じステージは前回の出力を再利用する
+        stages = {}
+        reused_stages = []
+        # ステージごとに、APIの応答（llm）かデフォルト値（fallback）かを記録する
+        sections = {}
+
+        def record(name, input_key, output):
+            sections[name] = "fallback" if _is_fallback(output) else "llm"
+            if sections[name] == "fallback":
+                FALLBACK_RESULTS.labels(stage=name).inc()
+            # デフォルト値は次回の再利用の対象にしない
+            if sections[name] == "llm":
+                stages[name] = {"input": input_key, "output": output}
+            emit(name, output)
+
+        def run_or_reuse(name, input_key, func, *args):
+            prior_stage = prior["stages"].get(name) if prior is not None else None
+            if prior_stage is not None and prior_stage["input"] == input_key:
+                reused_stages.append(name)
+                output = prior_stage["output"]
+            else:
+                output = self._run_stage(timings, name, func, *args)
+            record(name, input_key, output)
+            return output
+
+        def run_visual_combined():
+            outputs = {}
+            pending = {}
+            for device_type, screenshot_path in page.screenshots.items():
+                name = f"analyze_screenshot_{device_type}"
+                prior_stage = prior["stages"].get(name) if prior is not None else None
+                if prior_stage is not None and prior_stage["input"] == stage_inputs[name]:
+                    reused_stages.append(name)
+                    outputs[device_type] = prior_stage["output"]
+                else:
+                    pending[device_type] = screenshot_path
+            if pending:
+                outputs.update(self._run_stage(timings, "analyze_screenshots", self.analyze_screenshots, pending))
+
+            for device_type, output in outputs.items():
+                name = f"analyze_screenshot_{device_type}"
+                record(name, stage_inputs[name], output)
+            return outputs
+
+        # 依存関係のないステージを並行して投入する。ワーカーが1つなら従来どおりの逐次実行になる
+        max_workers = self.max_workers if concurrent else 1
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # 2. テキスト分析・視覚分析（すべて同じページ読み込みの成果物を使う）
+            if concurrent:
+                text_analysis = executor.submit(
+                    tracing.wrap(run_or_reuse), "analyze_content", stage_inputs["analyze_content"],
+                    self.analyze_content, page.document)
+            else:
+                # 逐次実行では、テキスト分析を終えてから視覚分析に進む
+                text_analysis = run_or_reuse("analyze_content", stage_inputs["analyze_content"],
+                                             self.analyze_content, page.document)
+            # テキストのみのモードではスクリーンショットがないので、視覚分析は行わない
+            if self.vision_mode == "combined":
+                # 変更のあったデバイスの画像だけを1回のリクエストでまとめて分析する
+                # （並行実行時は、テキスト分析がワーカーで並行して進む）
+                visuals = run_visual_combined()
+            else:
+                visuals = {
+                    device_type: executor.submit(
+                        tracing.wrap(run_or_reuse), f"analyze_screenshot_{device_type}",
+                        stage_inputs[f"analyze_screenshot_{device_type}"],
+                        self.analyze_screenshot, screenshot_path, device_type)
+                    for device_type, screenshot_path in page.screenshots.items()
+                }
+
+            # 3. 総合分析
+            combined_analysis = self._run_stage(
+                timings, "combine_analyses", self.combine_analyses,
+                text_analysis=text_analysis,
+                visual_desktop=visuals.get("desktop"),
+                visual_mobile=visuals.get("mobile")
+            )
+            emit("combine_analyses", combined_analysis)
 
-        # 6. 改善提案の生成
-        improvement_suggestions = self.get_improvement_suggestions(combined_analysis)
-        print("改善提案生成完了")
+        # 4. 改善提案の生成
+        improvement_suggestions = run_or_reuse(
+            "get_improvement_suggestions", stable_hash(combined_analysis),
+            self.get_improvement_suggestions, combined_analysis)
 
-        # 7. 結果の構築
+        timings["total"] = round(time.perf_counter() - started_at, 3)
+
+        # 5. 結果の構築
         result = {
             "overall_score": combined_analysis["overall_score"],
             "category_scores": combined_analysis["category_scores"],
             "strengths": combined_analysis["strengths"],
             "weaknesses": combined_analysis["weaknesses"],
             "improvements": improvement_suggestions,
-            "screenshots": {
-                "desktop": desktop_screenshot,
-                "mobile": mobile_screenshot
-            }
+            "screenshots": dict(page.screenshots),
+            "render_mode": "full" if page.screenshots else "text",
+            "sections": sections,
+            "timings": timings,
+            "incremental": {"reused": False, "reused_stages": reused_stages}
         }
+        result["id"] = self.results.save(url, result)
 
-        print("分析完了、結果を返します")
+        if self.incremental:
+            self.page_state.save(url, page.fetch.etag, page.fetch.last_modified, fingerprint, stages, result)
+
+        print(f"分析完了、結果を返します（所要時間: {timings['total']}秒）")
         return result
 
-    def get_website_content(self, url):
-        """ウェブサイトのHTMLコンテンツを取得"""
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    def _reuse_result(self, url, prior, fetch, timings, started_at, reason):
+        """前回の分析結果をそのまま返す"""
+        self.page_state.update_validators(url, fetch.etag, fetch.last_modified)
+        timings["total"] = round(time.perf_counter() - started_at, 3)
+
+        result = prior["result"]
+        # 再利用する結果が参照するスクリーンショットを保持期限による削除から外す
+        get_screenshot_store().touch(result.get("screenshots", {}).values())
+        result["timings"] = timings
+        result["incremental"] = {
+            "reused": True,
+            "reason": reason,
+            "analyzed_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(prior["updated_at"]))
         }
+        print(f"前回の分析結果を再利用します（所要時間: {timings['total']}秒）")
+        return result
+
+    def _run_stage(self, timings, name, func, *args, **kwargs):
+        """ステージを実行し、実行時間をtimingsに記録する
 
+        引数にFutureが含まれる場合は、その結果が揃ってから計測を開始する。
+        """
+        args = [arg.result() if isinstance(arg, Future) else arg for arg in args]
+        kwargs = {key: value.result() if isinstance(value, Future) else value
+                  for key, value in kwargs.items()}
+
+        start = time.perf_counter()
         try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            return response.text
-        except Exception as e:
-            print(f"コンテンツ取得エラー: {str(e)}")
-            return "<html><body>コンテンツを取得できませんでした</body></html>"
+            with tracing.span(name):
+                return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            STAGE_DURATION.labels(stage=name).observe(elapsed)
+            timings[name] = round(elapsed, 3)
+            print(f"{name} 完了 ({timings[name]}秒)")
+
+    def get_website_content(self, url):
+        """ウェブサイトのHTMLコンテンツを取得"""
+        return self.fetch_website_content(url).html
+
+    def fetch_website_content(self, url, etag=None, last_modified=None):
+        """ウェブサイトのHTMLコンテンツを取得し、ETag・Last-Modifiedとともに返す
+
+        etag / last_modified を渡すと条件付きリクエストを送り、
+        変更がなければ not_modified=True（html は None）の結果を返す。
+        """
+        return fetch_html(url, etag, last_modified)
+
+    def _chat(self, model, messages, validate=None, use_cache=True, **params):
+        """Chat Completions APIを呼び出して応答テキストを返す
+
+        同じモデル・プロンプト・画像の組み合わせはキャッシュから返す。
+        validate が指定された場合、それを満たす応答だけをキャッシュする。
+        """
+        cache_key = None
+        if use_cache and self.cache.enabled:
+            cache_key = self.cache.make_key(model, messages, params)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                print(f"LLMキャッシュヒット: {model}")
+                LLM_CALLS.labels(model=model, outcome="cache_hit").inc()
+                return cached
+
+        response = self.llm.create(model=model, messages=messages, **params)
+        content = response.choices[0].message.content
+
+        if cache_key is not None and (validate is None or validate(content)):
+            self.cache.put(cache_key, content)
+        return content
 
     def analyze_content(self, html_content):
-        """HTMLコンテンツのCVR分析"""
-        # BeautifulSoupでHTMLを解析
-        soup = BeautifulSoup(html_content, 'html.parser')
+        """HTMLコンテンツのCVR分析
+
+        html_content にはHTML文字列か、解析済みの DocumentIndex を渡せる。
+        """
+        # HTMLを解析（解析済みの索引があればそれを使う）
+        document = html_content if isinstance(html_content, DocumentIndex) else DocumentIndex(html_content)
 
         # メタデータ抽出
-        title = soup.title.string if soup.title else "タイトルなし"
-        meta_description = soup.find('meta', attrs={'name': 'description'})
-        description = meta_description['content'] if meta_description else "説明なし"
+        title = document.title or "タイトルなし"
+        description = document.description or "説明なし"
 
         # 重要な要素の抽出
-        headings = [h.text.strip() for h in soup.find_all(['h1', 'h2', 'h3'])]
-        cta_buttons = [a.text.strip() for a in soup.find_all('a', class_=lambda c: c and ('btn' in c or 'button' in c))]
-        forms = soup.find_all('form')
-        form_count = len(forms)
+        headings = document.heading_texts(("h1", "h2", "h3"))
+        cta_buttons = document.cta_texts(("a",))
+        form_count = len(document.forms)
 
         # テキストコンテンツをOpenAI APIに送信
         prompt = (
@@ -173,16 +393,16 @@ class CVRAnalyzer:
         )
 
         try:
-            response = self.client.chat.completions.create(
+            response_content = self._chat(
                 model="gpt-4",
                 messages=[
                     {"role": "system", "content": "あなたはCVR最適化の専門家です。JSONフォーマットで回答してください。"},
                     {"role": "user", "content": prompt}
-                ]
+                ],
+                validate=lambda content: _extract_json(content, "{", "}") is not None
             )
 
             # レスポンス内容をデバッグ出力
-            response_content = response.choices[0].message.content
             print(f"テキスト分析レスポンス（先頭部分）: {response_content[:100]}...")
 
             # JSONの先頭と末尾をチェック
@@ -201,7 +421,8 @@ class CVRAnalyzer:
 
             # JSON解析に失敗した場合はデフォルト値を返す
             print("有効なJSONが見つからなかったため、デフォルト結果を返します")
-            return {
+            JSON_PARSE_FAILURES.labels(stage="analyze_content").inc()
+            return _mark_fallback({
                 "scores": {
                     "value_proposition": 5,
                     "cta_visibility": 5,
@@ -212,11 +433,11 @@ class CVRAnalyzer:
                 "strengths": ["分析中にエラーが発生しました"],
                 "weaknesses": ["分析中にエラーが発生しました"],
                 "improvement_suggestions": ["分析を再試行してください"]
-            }
+            })
         except Exception as e:
             print(f"テキスト分析エラー: {str(e)}")
             traceback.print_exc()
-            return {
+            return _mark_fallback({
                 "scores": {
                     "value_proposition": 5,
                     "cta_visibility": 5,
@@ -227,17 +448,19 @@ class CVRAnalyzer:
                 "strengths": ["分析中にエラーが発生しました"],
                 "weaknesses": ["分析中にエラーが発生しました"],
                 "improvement_suggestions": ["分析を再試行してください"]
-            }
+            })
 
     def analyze_screenshot(self, screenshot_path, device_type):
         """スクリーンショット画像のCVR分析"""
         print(f"スクリーンショット分析開始: {screenshot_path}, デバイス: {device_type}")
         try:
-            # 画像の読み込みとエンコード
-            with open(screenshot_path, "rb") as image_file:
-                image_data = base64.b64encode(image_file.read()).decode('utf-8')
+            # 画像を縮小・分割して再エンコード（ページ上部から順のタイル）
+            image_urls = prepare_screenshot(screenshot_path)
 
             # プロンプトの作成
+            tile_note = ""
+            if len(image_urls) > 1:
+                tile_note = f"スクリーンショットはページ上部から順に{len(image_urls)}枚の画像に分割されています。\n\n"
             prompt = (
                 f"あなたはUXとCVR最適化の専門家です。この{device_type}用ウェブサイトのスクリーンショットを分析し、"
                 f"CVR導線の視覚的な観点から評価してください。\n\n"
@@ -253,6 +476,7 @@ class CVRAnalyzer:
                 f"3. レスポンシブデザイン品質\n"
                 f"4. 色彩とコントラスト効果\n"
                 f"5. 全体的なUX品質\n\n"
+                f"{tile_note}"
                 f"また、視覚面でのCVR向上のための具体的な改善案を3〜5つ提案してください。\n\n"
                 f"以下の形式で回答してください（必ずJSONフォーマットで）:\n"
                 f"{{\n"
@@ -272,20 +496,19 @@ class CVRAnalyzer:
             # まずはAPI呼び出しを試みる
             try:
                 # OpenAI API (GPT-4) で画像分析
-                response = self.client.chat.completions.create(
+                response_content = self._chat(
                     model="gpt-4o",  # GPT-4oモデルを使用
                     messages=[
                         {"role": "system", "content": "あなたはUXとCVR最適化の専門家です。JSONフォーマットで回答してください。"},
-                        {"role": "user", "content": [
-                            {"type": "text", "text": prompt},
-                            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_data}"}}
+                        {"role": "user", "content": [{"type": "text", "text": prompt}] + [
+                            {"type": "image_url", "image_url": {"url": image_url}} for image_url in image_urls
                         ]}
                     ],
+                    validate=lambda content: _extract_json(content, "{", "}") is not None,
                     max_tokens=2000
                 )
 
                 # レスポンスの内容をデバッグ出力
-                response_content = response.choices[0].message.content
                 print(f"スクリーンショット分析レスポンス（先頭部分）: {response_content[:100]}...")
 
                 # JSONの抽出を試みる
@@ -304,38 +527,18 @@ class CVRAnalyzer:
 
                 # APIからの応答をJSONとして解析できない場合
                 print("API応答からJSONを抽出できませんでした。デフォルト結果を返します。")
+                JSON_PARSE_FAILURES.labels(stage="analyze_screenshot").inc()
             except Exception as e:
                 print(f"API呼び出しエラー: {str(e)}")
                 traceback.print_exc()
 
             # API呼び出しかJSON解析に失敗した場合のデフォルト値
             print("デフォルト分析結果を返します")
-            return {
-                "scores": {
-                    "visual_hierarchy": 6,
-                    "cta_visibility": 6,
-                    "responsive_design": 6,
-                    "color_contrast": 6,
-                    "overall_ux": 6
-                },
-                "strengths": [
-                    f"{device_type}表示は基本的なユーザビリティの要件を満たしています",
-                    f"{device_type}向けのレイアウトが考慮されています"
-                ],
-                "weaknesses": [
-                    f"{device_type}表示での視覚的階層が最適化されていない可能性があります",
-                    f"{device_type}表示でのCTAの配置や視認性に改善の余地があります"
-                ],
-                "improvement_suggestions": [
-                    f"{device_type}表示でのCTAボタンのサイズと色を最適化する",
-                    f"{device_type}表示での重要な情報の優先順位を視覚的に明確にする",
-                    f"{device_type}表示での色のコントラストを改善して可読性を高める"
-                ]
-            }
+            return self._default_visual_analysis(device_type)
         except Exception as e:
             print(f"スクリーンショット分析の全体エラー: {str(e)}")
             traceback.print_exc()
-            return {
+            return _mark_fallback({
                 "scores": {
                     "visual_hierarchy": 5,
                     "cta_visibility": 5,
@@ -346,45 +549,148 @@ class CVRAnalyzer:
                 "strengths": ["分析中にエラーが発生しました"],
                 "weaknesses": ["分析中にエラーが発生しました"],
                 "improvement_suggestions": ["分析を再試行してください"]
-            }
+            })
+
+    def analyze_screenshots(self, screenshots):
+        """複数デバイスのスクリーンショットを1回のリクエストでまとめて分析する
+
+        screenshots はデバイスタイプ -> スクリーンショットのパス。応答はJSONスキーマで構造化し、
+        ローカルでも検証する。検証に失敗したデバイスだけを問い合わせ直し、
+        それでも失敗したデバイスにはデフォルトの分析結果を返す。
+        """
+        print(f"スクリーンショット一括分析開始: {', '.join(screenshots)}")
+        results = {}
+        pending = dict(screenshots)
+
+        for attempt in range(self.vision_retries + 1):
+            if not pending:
+                break
+            devices = list(pending)
+            try:
+                response_content = self._chat(
+                    model="gpt-4o",
+                    messages=self._visual_messages(pending),
+                    validate=lambda content: not _visual_response_errors(_loads_json(content), devices),
+                    response_format=_visual_response_format(devices),
+                    max_tokens=1500 * len(devices)
+                )
+                data = _loads_json(response_content)
+                if data is None:
+                    JSON_PARSE_FAILURES.labels(stage="analyze_screenshots").inc()
+            except Exception as e:
+                print(f"API呼び出しエラー: {str(e)}")
+                traceback.print_exc()
+                data = None
+
+            errors = _visual_response_errors(data, devices)
+            for device_type in devices:
+                if device_type in errors:
+                    print(f"{device_type}の視覚分析の応答が不正です（{attempt + 1}回目）: {errors[device_type]}")
+                else:
+                    results[device_type] = data[device_type]
+                    del pending[device_type]
+
+        for device_type in pending:
+            print(f"{device_type}のデフォルト分析結果を返します")
+            results[device_type] = self._default_visual_analysis(device_type)
+        return results
+
+    def _visual_messages(self, screenshots):
+        """デバイスごとの画像を見出し付きで並べた、一括分析用のメッセージ"""
+        device_names = "・".join(screenshots)
+        prompt = (
+            f"あなたはUXとCVR最適化の専門家です。同じウェブサイトの{device_names}用スクリーンショットを分析し、"
+            f"デバイスごとにCVR導線の視覚的な観点から評価してください。\n\n"
+            f"以下の点に注目して分析してください:\n"
+            f"1. レイアウトとビジュアル階層\n"
+            f"2. CTAボタンの目立ち具合と配置\n"
+            f"3. 情報の流れと視線誘導\n"
+            f"4. モバイル/デスクトップの最適化度（デバイスに応じて）\n"
+            f"5. 色彩とコントラストの効果\n\n"
+            f"以下の観点から1〜10の整数で評価し、それぞれ強みと弱みを挙げてください:\n"
+            f"1. 視覚的階層とフロー (visual_hierarchy)\n"
+            f"2. CTAの視認性 (cta_visibility)\n"
+            f"3. レスポンシブデザイン品質 (responsive_design)\n"
+            f"4. 色彩とコントラスト効果 (color_contrast)\n"
+            f"5. 全体的なUX品質 (overall_ux)\n\n"
+            f"また、デバイスごとに視覚面でのCVR向上のための具体的な改善案を3〜5つ提案してください。\n"
+            f"各デバイスの画像はページ上部から順に並んでいます。"
+        )
+
+        content = [{"type": "text", "text": prompt}]
+        for device_type, screenshot_path in screenshots.items():
+            # 画像を縮小・分割して再エンコード（ページ上部から順のタイル）
+            image_urls = prepare_screenshot(screenshot_path)
+            content.append({"type": "text", "text": f"{device_type} のスクリーンショット（{len(image_urls)}枚）:"})
+            content.extend({"type": "image_url", "image_url": {"url": image_url}} for image_url in image_urls)
+
+        return [
+            {"role": "system", "content": "あなたはUXとCVR最適化の専門家です。指定されたJSONスキーマに従って回答してください。"},
+            {"role": "user", "content": content}
+        ]
+
+    def _default_visual_analysis(self, device_type):
+        """視覚分析ができなかった場合のデフォルト結果"""
+        return _mark_fallback({
+            "scores": {
+                "visual_hierarchy": 6,
+                "cta_visibility": 6,
+                "responsive_design": 6,
+                "color_contrast": 6,
+                "overall_ux": 6
+            },
+            "strengths": [
+                f"{device_type}表示は基本的なユーザビリティの要件を満たしています",
+                f"{device_type}向けのレイアウトが考慮されています"
+            ],
+            "weaknesses": [
+                f"{device_type}表示での視覚的階層が最適化されていない可能性があります",
+                f"{device_type}表示でのCTAの配置や視認性に改善の余地があります"
+            ],
+            "improvement_suggestions": [
+                f"{device_type}表示でのCTAボタンのサイズと色を最適化する",
+                f"{device_type}表示での重要な情報の優先順位を視覚的に明確にする",
+                f"{device_type}表示での色のコントラストを改善して可読性を高める"
+            ]
+        })
+
+    def combine_analyses(self, text_analysis, visual_desktop=None, visual_mobile=None):
+        """テキスト分析と視覚分析の結果を統合
+
+        視覚分析がない場合（テキストのみのモード）は、テキスト分析だけで評価できるカテゴリを返す。
+        """
+        visuals = [(label, visual) for label, visual in (("デスクトップ", visual_desktop), ("モバイル", visual_mobile))
+                   if visual is not None]
+
+        def average(text_score, key):
+            scores = ([text_score] if text_score is not None else []) + [v["scores"][key] for _, v in visuals]
+            return sum(scores) / len(scores)
 
-    def combine_analyses(self, text_analysis, visual_desktop, visual_mobile):
-        """テキスト分析と視覚分析の結果を統合"""
         # 各カテゴリスコアの計算
         category_scores = {
             "content_quality": text_analysis["scores"]["value_proposition"],
-            "cta_effectiveness": (text_analysis["scores"]["cta_visibility"] +
-                                visual_desktop["scores"]["cta_visibility"] +
-                                visual_mobile["scores"]["cta_visibility"]) / 3,
-            "user_flow": (text_analysis["scores"]["user_flow"] +
-                        visual_desktop["scores"]["visual_hierarchy"] +
-                        visual_mobile["scores"]["visual_hierarchy"]) / 3,
+            "cta_effectiveness": average(text_analysis["scores"]["cta_visibility"], "cta_visibility"),
+            "user_flow": average(text_analysis["scores"]["user_flow"], "visual_hierarchy"),
             "form_usability": text_analysis["scores"]["form_usability"],
-            "trust_elements": text_analysis["scores"]["trust_elements"],
-            "visual_design": (visual_desktop["scores"]["color_contrast"] +
-                            visual_mobile["scores"]["color_contrast"]) / 2,
-            "responsive_design": (visual_desktop["scores"]["responsive_design"] +
-                                visual_mobile["scores"]["responsive_design"]) / 2,
-            "overall_ux": (visual_desktop["scores"]["overall_ux"] +
-                        visual_mobile["scores"]["overall_ux"]) / 2
+            "trust_elements": text_analysis["scores"]["trust_elements"]
         }
+        if visuals:
+            category_scores["visual_design"] = average(None, "color_contrast")
+            category_scores["responsive_design"] = average(None, "responsive_design")
+            category_scores["overall_ux"] = average(None, "overall_ux")
 
         # 総合スコアの計算
         all_scores = list(category_scores.values())
         overall_score = sum(all_scores) / len(all_scores)
 
         # 強みと弱みの統合
-        strengths = (
-            text_analysis["strengths"] +
-            [f"デスクトップ: {s}" for s in visual_desktop["strengths"]] +
-            [f"モバイル: {s}" for s in visual_mobile["strengths"]]
-        )
+        strengths = text_analysis["strengths"] + [
+            f"{label}: {s}" for label, visual in visuals for s in visual["strengths"]
+        ]
 
-        weaknesses = (
-            text_analysis["weaknesses"] +
-            [f"デスクトップ: {w}" for w in visual_desktop["weaknesses"]] +
-            [f"モバイル: {w}" for w in visual_mobile["weaknesses"]]
-        )
+        weaknesses = text_analysis["weaknesses"] + [
+            f"{label}: {w}" for label, visual in visuals for w in visual["weaknesses"]
+        ]
 
         return {
             "overall_score": round(overall_score, 1),
@@ -479,16 +785,16 @@ class CVRAnalyzer:
 
             # API呼び出しを試みる
             try:
-                response = self.client.chat.completions.create(
+                response_content = self._chat(
                     model="gpt-4",
                     messages=[
                         {"role": "system", "content": "あなたはCVR最適化の専門家です。JSONフォーマットで回答してください。"},
                         {"role": "user", "content": prompt}
-                    ]
+                    ],
+                    validate=lambda content: bool(_extract_json(content, "[", "]"))
                 )
 
                 # レスポンスの内容をデバッグ出力
-                response_content = response.choices[0].message.content
                 print(f"改善提案レスポンス（先頭部分）: {response_content[:100]}...")
 
                 # JSONの抽出を試みる
@@ -507,6 +813,7 @@ class CVRAnalyzer:
                         print(f"改善提案JSON解析エラー: {str(e)}")
 
                 print("改善提案JSONの抽出に失敗。デフォルト提案を使用します。")
+                JSON_PARSE_FAILURES.labels(stage="get_improvement_suggestions").inc()
             except Exception as e:
                 print(f"改善提案API呼び出しエラー: {str(e)}")
                 traceback.print_exc()
@@ -517,13 +824,98 @@ class CVRAnalyzer:
 
         # APIからの提案取得に失敗した場合はデフォルト提案を返す
         print("デフォルトの改善提案を返します")
-        return default_improvements
-
-# URL文字列からファイル名に適した文字列を生成する補助関数
-def url_to_filename(url):
-    """URLからファイル名として使える文字列を生成"""
-    # httpやhttpsなどのプロトコル部分を除去
-    url = url.replace("http://", "").replace("https://", "")
-    # 特殊文字を置換
-    url = url.replace("/", "_").replace(".", "-").replace(":", "_").replace("?", "_").replace("&", "_")
-    return url
+        return _mark_fallback(default_improvements)
+
+
+def _mark_fallback(value):
+    """APIの応答ではなくデフォルト値であることを記録する（リストは各要素に記録する）"""
+    for item in (value if isinstance(value, list) else [value]):
+        item["fallback"] = True
+    return value
+
+
+def _is_fallback(value):
+    items = value if isinstance(value, list) else [value]
+    return any(isinstance(item, dict) and item.get("fallback") for item in items)
+
+
+def _extract_json(content, open_char, close_char):
+    """応答テキストから最初の open_char と最後の close_char で囲まれたJSONを取り出す。失敗時はNone"""
+    cleaned_content = content.strip()
+    json_start = cleaned_content.find(open_char)
+    json_end = cleaned_content.rfind(close_char) + 1
+    if json_start < 0 or json_end <= json_start:
+        return None
+    try:
+        return json.loads(cleaned_content[json_start:json_end])
+    except json.JSONDecodeError:
+        return None
+
+
+VISUAL_SCORE_KEYS = ("visual_hierarchy", "cta_visibility", "responsive_design", "color_contrast", "overall_ux")
+VISUAL_LIST_KEYS = ("strengths", "weaknesses", "improvement_suggestions")
+
+
+def _visual_response_format(devices):
+    """デバイスごとの視覚分析を要求するJSONスキーマ（Structured Outputs）"""
+    analysis_schema = {
+        "type": "object",
+        "properties": {
+            "scores": {
+                "type": "object",
+                "properties": {key: {"type": "integer"} for key in VISUAL_SCORE_KEYS},
+                "required": list(VISUAL_SCORE_KEYS),
+                "additionalProperties": False
+            },
+            **{key: {"type": "array", "items": {"type": "string"}} for key in VISUAL_LIST_KEYS}
+        },
+        "required": ["scores", *VISUAL_LIST_KEYS],
+        "additionalProperties": False
+    }
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "visual_analysis",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {device_type: analysis_schema for device_type in devices},
+                "required": list(devices),
+                "additionalProperties": False
+            }
+        }
+    }
+
+
+def _visual_response_errors(data, devices):
+    """一括分析の応答を検証し、デバイスタイプ -> エラー内容 を返す（問題がなければ空）"""
+    if not isinstance(data, dict):
+        return {device_type: "JSONオブジェクトではありません" for device_type in devices}
+
+    errors = {}
+    for device_type in devices:
+        analysis = data.get(device_type)
+        if not isinstance(analysis, dict) or not isinstance(analysis.get("scores"), dict):
+            errors[device_type] = "scores がありません"
+            continue
+        scores = analysis["scores"]
+        invalid = [key for key in VISUAL_SCORE_KEYS
+                   if isinstance(scores.get(key), bool) or not isinstance(scores.get(key), (int, float))
+                   or not 1 <= scores[key] <= 10]
+        if invalid:
+            errors[device_type] = f"スコアが1〜10の数値ではありません: {', '.join(invalid)}"
+            continue
+        for key in VISUAL_LIST_KEYS:
+            values = analysis.get(key)
+            if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+                errors[device_type] = f"{key} が文字列のリストではありません"
+                break
+    return errors
+
+
+def _loads_json(content):
+    """構造化出力の応答をJSONとして読む。失敗時はNone"""
+    try:
+        return json.loads(content)
+    except (TypeError, json.JSONDecodeError):
+        return None
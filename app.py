@@ -1,15 +1,103 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for
+import csv
+import io
 import json
 import os
+import hmac
+import time
 from datetime import datetime
+from functools import wraps
 import traceback
 from analyzer import CVRAnalyzer  # 新しい分析エンジンをインポート
+from contact_store import ContactStore, EXPORT_FIELDS
+from jobs import JobManager, QueueFullError
+import metrics
+from render_detector import RENDER_MODES
 
 app = Flask(__name__)
 
 # CVR分析器のインスタンスを作成
 analyzer = CVRAnalyzer()
 
+# 分析はWebリクエストの外で、固定数のバックグラウンドワーカーが実行する
+# （CVR_JOB_WORKERS / CVR_JOB_QUEUE_SIZE で調整）
+job_manager = JobManager(analyzer.analyze_website)
+
+# 進捗のServer-Sent Eventsを1回の応答で配信し続ける最大秒数（超えたらクライアントが再接続する）
+SSE_MAX_SECONDS = float(os.getenv("CVR_SSE_MAX_SECONDS", "30"))
+
+# お問い合わせの保存先（CVR_CONTACT_STORE_PATH、既定は data/contacts.sqlite3）
+contact_store = ContactStore()
+
+# 起動を速くするため、初めて使うときまで読み込まない依存ライブラリ
+WARM_UP_MODULES = ("openai", "bs4", "lxml.etree", "requests", "PIL.Image", "selenium.webdriver",
+                   "webdriver_manager.chrome")
+
+
+def warm_up():
+    """遅延読み込みしている依存ライブラリを先に読み込む
+
+    gunicorn --preload などのプリフォーク型サーバーでは、CVR_WARMUP=1 でマスタープロセスが
+    読み込んでおけば、ワーカーはfork時にそれを引き継ぎ、最初の分析で読み込みを待たない。
+    スレッドや接続は作らないので、fork前に呼んでも安全。
+    """
+    for name in WARM_UP_MODULES:
+        try:
+            __import__(name)
+        except ImportError as e:
+            print(f"ウォームアップで読み込めないモジュールがあります: {name}（{str(e)}）")
+
+if os.getenv('CVR_WARMUP') == '1':
+    warm_up()
+
+
+def normalize_url(url):
+    """URLのフォーマット確認と修正"""
+    url = (url or '').strip()
+    if url and not url.startswith(('http://', 'https://')):
+        url = 'https://' + url
+    return url
+
+def job_options(payload):
+    """リクエストから分析オプションを取り出す（mode: full / auto / text、trace: 1でトレースを記録）"""
+    options = {}
+    mode = payload.get('mode')
+    if mode:
+        if mode not in RENDER_MODES:
+            raise ValueError(f"不明な分析モードです: {mode}")
+        options["render_mode"] = mode
+    if str(payload.get('trace', '')).lower() in ('1', 'true', 'on'):
+        options["trace"] = True
+    return options
+
+def admin_required(view):
+    """管理用APIを CVR_ADMIN_TOKEN のBearerトークンで保護する（未設定なら無効にする）"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = os.getenv('CVR_ADMIN_TOKEN')
+        if not token:
+            return jsonify({"error": "管理用APIは無効です"}), 404
+        auth = request.headers.get('Authorization', '')
+        if not auth.startswith('Bearer ') or not hmac.compare_digest(auth[len('Bearer '):], token):
+            return jsonify({"error": "認証が必要です"}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def contact_filters(args):
+    """お問い合わせの検索条件（email / url / since / until）を取り出す"""
+    return {
+        "email": args.get('email'),
+        "url": normalize_url(args.get('url')) or None,
+        "since": args.get('since', type=float),
+        "until": args.get('until', type=float)
+    }
+
+def csv_cell(value):
+    """表計算ソフトで数式として解釈される値（=, +, -, @ などで始まる）の先頭に ' を付ける"""
+    if isinstance(value, str) and value.startswith(('=', '+', '-', '@', '\t', '\r')):
+        return "'" + value
+    return value
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -18,25 +106,145 @@ def index():
 def analyze():
     try:
         # URLの取得
-        url = request.form.get('url')
+        url = normalize_url(request.form.get('url'))
         if not url:
             return jsonify({"error": "URLが入力されていません"})
 
-        # URLのフォーマット確認と修正
-        if not url.startswith(('http://', 'https://')):
-            url = 'https://' + url
-
-        # サイトの分析実行（新しい分析エンジンを使用）
-        result = analyzer.analyze_website(url)
-
-        # 結果をHTMLとして表示
-        return render_template('result.html', url=url, result=result)
+        # 分析ジョブを登録し、進捗ページへ移動する
+        job = job_manager.submit(url, **job_options(request.form))
+        return redirect(url_for('job_page', job_id=job.id))
 
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         print(f"アプリケーションエラー: {str(e)}")
         print(traceback.format_exc())
         return jsonify({"error": str(e)})
 
+@app.route('/jobs/<job_id>')
+def job_page(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "指定されたジョブが見つかりません"}), 404
+
+    if job.status == "done":
+        # 保存済みの結果は固定のURLで表示する（再読み込みやブックマークで再分析しない）
+        if job.result.get("id"):
+            return redirect(url_for('result_page', result_id=job.result["id"]))
+        # 結果をHTMLとして表示
+        return render_template('result.html', url=job.url, result=job.result)
+    if job.status == "failed":
+        return jsonify({"error": job.error}), 500
+
+    # 完了するまで進捗ページがステータスをポーリングする
+    return render_template('progress.html', url=job.url, job_id=job.id)
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    payload = request.get_json(silent=True) or request.form
+    url = normalize_url(payload.get('url'))
+    if not url:
+        return jsonify({"error": "URLが入力されていません"}), 400
+
+    try:
+        job = job_manager.submit(url, **job_options(payload))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 503
+
+    return jsonify({
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": url_for('job_status', job_id=job.id),
+        "result_url": url_for('job_page', job_id=job.id)
+    }), 202
+
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "指定されたジョブが見つかりません"}), 404
+    return jsonify(job.to_dict(include_result=request.args.get('result') == '1'))
+
+@app.route('/api/jobs/<job_id>/events')
+def job_events(job_id):
+    """分析の途中経過を Server-Sent Events で配信する
+
+    再接続時は Last-Event-ID の次のイベントから送る。done / failed を送ったら終了する。
+    1回の応答は CVR_SSE_MAX_SECONDS 秒で打ち切り、続きはクライアントの再接続で送る。
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "指定されたジョブが見つかりません"}), 404
+    # 既定値には type が適用されないので、ヘッダーとクエリは別々に数値にする
+    last_id = request.args.get('after', 0, type=int)
+    if 'Last-Event-ID' in request.headers:
+        try:
+            last_id = int(request.headers['Last-Event-ID'])
+        except ValueError:
+            pass
+
+    def stream(last_id):
+        # 1回の応答でワーカーを占有し続けないよう、一定時間で応答を終える。
+        # ブラウザの EventSource は retry のミリ秒後に Last-Event-ID 付きで再接続する
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        yield "retry: 1000\n\n"
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            events = job.wait_events(last_id, timeout=min(15.0, remaining))
+            if not events:
+                if job.finished or time.monotonic() >= deadline:
+                    return
+                # プロキシに接続を切られないよう、イベントがない間もコメント行を送る
+                yield ": keep-alive\n\n"
+                continue
+            for event in events:
+                last_id = event["id"]
+                yield f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'], ensure_ascii=False)}\n\n"
+                if event["event"] in ("done", "failed"):
+                    return
+
+    return Response(stream(last_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/results/<result_id>')
+def result_page(result_id):
+    stored = analyzer.results.get(result_id)
+    if stored is None:
+        return jsonify({"error": "指定された分析結果が見つかりません"}), 404
+    return render_template('result.html', url=stored['url'], result=stored['result'])
+
+@app.route('/api/results/<result_id>')
+def get_result(result_id):
+    stored = analyzer.results.get(result_id)
+    if stored is None:
+        return jsonify({"error": "指定された分析結果が見つかりません"}), 404
+    return jsonify(stored)
+
+@app.route('/api/results/<base_id>/diff/<target_id>')
+def diff_results(base_id, target_id):
+    """2回の分析のカテゴリ別スコアを比較する（target - base）"""
+    diff = analyzer.results.diff(base_id, target_id)
+    if diff is None:
+        return jsonify({"error": "指定された分析結果が見つかりません"}), 404
+    return jsonify(diff)
+
+@app.route('/api/history')
+def result_history():
+    """URLの分析履歴を新しい順に返す"""
+    url = normalize_url(request.args.get('url'))
+    if not url:
+        return jsonify({"error": "URLが入力されていません"}), 400
+
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    offset = request.args.get('offset', 0, type=int)
+    return jsonify({"url": url, "results": analyzer.results.history(url, limit=limit, offset=offset)})
+
 @app.route('/contact', methods=['POST'])
 def contact():
     try:
@@ -52,15 +260,8 @@ def contact():
             'interests': request.form.getlist('interests[]')  # チェックボックスの複数選択
         }
 
-        # お問い合わせをファイルに保存
-        contacts_dir = os.path.join(os.path.dirname(__file__), 'data', 'contacts')
-        os.makedirs(contacts_dir, exist_ok=True)
-
-        filename = f"{contact_data['timestamp'].replace(':', '-').replace(' ', '_')}.json"
-        filepath = os.path.join(contacts_dir, filename)
-
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(contact_data, f, ensure_ascii=False, indent=2)
+        # お問い合わせをストアに保存
+        contact_store.add(contact_data)
 
         # サンクスページを表示
         return render_template('thanks.html', name=contact_data['name'])
@@ -70,5 +271,51 @@ def contact():
         print(traceback.format_exc())
         return jsonify({"error": str(e)})
 
+@app.route('/api/contacts')
+@admin_required
+def list_contacts():
+    """お問い合わせを新しい順に返す（次のページは cursor に next_cursor を渡す）"""
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    return jsonify(contact_store.query(limit=limit, cursor=request.args.get('cursor'),
+                                       **contact_filters(request.args)))
+
+@app.route('/api/contacts/export')
+@admin_required
+def export_contacts():
+    """お問い合わせを古い順にストリーミングで出力する（format: jsonl / csv）"""
+    export_format = request.args.get('format', 'jsonl')
+    if export_format not in ('jsonl', 'csv'):
+        return jsonify({"error": f"不明な出力形式です: {export_format}"}), 400
+    contacts = contact_store.export(**contact_filters(request.args))
+
+    def stream_jsonl():
+        for contact in contacts:
+            yield json.dumps(contact, ensure_ascii=False) + "\n"
+
+    def stream_csv():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # Excelで文字化けしないようBOMを付ける
+        buffer.write('\ufeff')
+        writer.writerow(EXPORT_FIELDS)
+        for contact in contacts:
+            row = dict(contact, interests='; '.join(contact.get('interests') or []))
+            writer.writerow([csv_cell(row.get(field, '')) for field in EXPORT_FIELDS])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    if export_format == 'csv':
+        return Response(stream_csv(), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=contacts.csv'})
+    return Response(stream_jsonl(), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': 'attachment; filename=contacts.jsonl'})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheusのテキスト形式でメトリクスを出力する"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,213 @@
+"""URLリストを一括でCVR分析するコマンドラインツール
+
+使い方:
+    python batch.py urls.txt -o results.jsonl --concurrency 4 --per-host 1
+
+入力はCSV（url列または先頭列）、テキスト（1行1URL）、sitemap.xml（パスまたはURL）に対応する。
+結果は1URLにつき1行のJSONとして出力し、同じ出力ファイルを指定して再実行すると
+完了済みのURLを飛ばして中断したところから再開する。
+"""
+import os
+import csv
+import sys
+import json
+import time
+import argparse
+import threading
+import traceback
+import urllib.parse
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from analyzer import CVRAnalyzer
+from http_client import get_http_client
+from render_detector import RENDER_MODES
+
+SITEMAP_NS = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
+SITEMAP_MAX_BYTES = 50 * 1024 * 1024
+
+
+def read_urls(source):
+    """入力ファイル（またはsitemapのURL）から分析対象のURLを読み込む"""
+    lower = source.lower()
+    if lower.endswith(".xml") or lower.startswith(("http://", "https://")):
+        urls = read_sitemap(source)
+    elif lower.endswith(".csv"):
+        urls = read_csv(source)
+    else:
+        with open(source, "r", encoding="utf-8") as f:
+            urls = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+    # 入力順を保ったまま重複を除く
+    seen = set()
+    unique = []
+    for url in urls:
+        if not url.startswith(("http://", "https://")):
+            url = "https://" + url
+        if url not in seen:
+            seen.add(url)
+            unique.append(url)
+    return unique
+
+
+def read_csv(path):
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        rows = list(csv.reader(f))
+    if not rows:
+        return []
+
+    header = [column.strip().lower() for column in rows[0]]
+    if "url" in header:
+        index = header.index("url")
+        rows = rows[1:]
+    else:
+        index = 0
+    return [row[index].strip() for row in rows if len(row) > index and row[index].strip()]
+
+
+def read_sitemap(source, depth=0):
+    """sitemap.xml（サイトマップインデックスを含む）から<loc>を読み込む"""
+    if source.startswith(("http://", "https://")):
+        # 途中で切れたXMLは解析できないので、上限（サイトマップの仕様上限の50MB）を超えたらエラーにする
+        response = get_http_client().get(source, max_bytes=SITEMAP_MAX_BYTES, allow_truncated=False)
+        response.raise_for_status()
+        root = ET.fromstring(response.content)
+    else:
+        root = ET.parse(source).getroot()
+
+    locs = [loc.text.strip() for loc in root.iter(f"{SITEMAP_NS}loc") if loc.text]
+    if root.tag == f"{SITEMAP_NS}sitemapindex" and depth < 3:
+        urls = []
+        for child in locs:
+            urls.extend(read_sitemap(child, depth + 1))
+        return urls
+    return locs
+
+
+def read_completed(output_path, retry_errors=False):
+    """既存の出力ファイルから完了済みのURLを読み込む（再開用）"""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 中断時に書きかけになった行は無視する
+                continue
+            if record.get("status") == "ok" or not retry_errors:
+                completed.add(record.get("url"))
+    return completed
+
+
+class HostLimiter:
+    """ホストごとの同時実行数とリクエスト間隔を制限する"""
+
+    def __init__(self, max_per_host=1, delay=0.0):
+        self.max_per_host = max_per_host
+        self.delay = delay
+        self._semaphores = {}
+        self._last_started = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, url):
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        with self._lock:
+            semaphore = self._semaphores.setdefault(host, threading.Semaphore(self.max_per_host))
+        semaphore.acquire()
+
+        # 同じホストへの直前のリクエストから delay 秒空ける
+        while True:
+            with self._lock:
+                wait = self._last_started.get(host, 0) + self.delay - time.monotonic()
+                if wait <= 0:
+                    self._last_started[host] = time.monotonic()
+                    return host
+            time.sleep(wait)
+
+    def release(self, host):
+        self._semaphores[host].release()
+
+
+def interleave_by_host(urls):
+    """同じホストのURLが連続しないよう、ホストごとに順番に並べ替える"""
+    by_host = {}
+    for url in urls:
+        by_host.setdefault(urllib.parse.urlsplit(url).netloc.lower(), []).append(url)
+
+    ordered = []
+    queues = list(by_host.values())
+    while queues:
+        for host_urls in queues:
+            ordered.append(host_urls.pop(0))
+        queues = [host_urls for host_urls in queues if host_urls]
+    return ordered
+
+
+def run_batch(urls, output_path, analyze, concurrency=2, max_per_host=1, host_delay=0.0):
+    """URLを並行して分析し、1件終わるごとに結果をJSON Linesで追記する"""
+    # 1つのホストの待ちで他のホストのURLが止まらないようにする
+    urls = interleave_by_host(urls)
+    limiter = HostLimiter(max_per_host, host_delay)
+    write_lock = threading.Lock()
+    counts = {"ok": 0, "error": 0}
+
+    with open(output_path, "a", encoding="utf-8") as output:
+        def process(url):
+            host = limiter.acquire(url)
+            started = time.perf_counter()
+            try:
+                record = {"url": url, "status": "ok", "result": analyze(url)}
+            except Exception as e:
+                traceback.print_exc()
+                record = {"url": url, "status": "error", "error": str(e)}
+            finally:
+                limiter.release(host)
+            record["elapsed"] = round(time.perf_counter() - started, 3)
+            record["finished_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+
+            with write_lock:
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+                counts[record["status"]] += 1
+                print(f"[{counts['ok'] + counts['error']}/{len(urls)}] {record['status']}: {url}", file=sys.stderr)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(process, urls))
+
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="URLリストを一括でCVR分析する")
+    parser.add_argument("source", help="CSV・テキスト・sitemap.xmlのパス、またはsitemapのURL")
+    parser.add_argument("-o", "--output", default="batch_results.jsonl", help="結果を追記するJSON Linesファイル")
+    parser.add_argument("-c", "--concurrency", type=int, default=2, help="同時に分析するURL数")
+    parser.add_argument("--per-host", type=int, default=1, help="同一ホストへの同時分析数の上限")
+    parser.add_argument("--host-delay", type=float, default=1.0, help="同一ホストへの分析開始間隔（秒）")
+    parser.add_argument("--retry-errors", action="store_true", help="前回エラーになったURLも再分析する")
+    parser.add_argument("--mode", choices=RENDER_MODES, help="レンダリングモード（auto: 必要なページだけブラウザを使う）")
+    args = parser.parse_args(argv)
+
+    urls = read_urls(args.source)
+    completed = read_completed(args.output, retry_errors=args.retry_errors)
+    pending = [url for url in urls if url not in completed]
+    print(f"対象URL: {len(urls)}件（完了済み {len(urls) - len(pending)}件をスキップ）", file=sys.stderr)
+    if not pending:
+        return 0
+
+    # 同時に分析するURL数だけブラウザを用意する
+    os.environ.setdefault("CVR_BROWSER_POOL_SIZE", str(args.concurrency))
+    analyzer = CVRAnalyzer()
+
+    analyze = partial(analyzer.analyze_website, render_mode=args.mode)
+    counts = run_batch(pending, args.output, analyze, args.concurrency,
+                       args.per_host, args.host_delay)
+    print(f"完了: 成功 {counts['ok']}件 / エラー {counts['error']}件", file=sys.stderr)
+    return 0 if counts["error"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
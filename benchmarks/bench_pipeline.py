@@ -0,0 +1,289 @@
+"""分析パイプラインのステージ別ベンチマーク
+
+ローカルの静的HTTPサーバーでフィクスチャのLP（small / huge / js_heavy）を配信し、
+OpenAI互換の偽エンドポイント（応答遅延を指定可能）に対して analyze_website と
+CVRRuleChecker.check_url を実行する。ステージごとのレイテンシのパーセンタイル、
+ピークメモリ、スループットをJSONで出力する。Pythonヒープのピークは、レイテンシに
+tracemallocのオーバーヘッドが乗らないよう、計測とは別の実行（フィクスチャごとに1回）で測る。
+
+使い方:
+    python benchmarks/bench_pipeline.py --iterations 5 --concurrency 2 --llm-latency 0.5 -o bench.json
+
+ページのレンダリングにはローカルのChromeが必要。
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import tracemalloc
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler, BaseHTTPRequestHandler
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+sys.path.insert(0, ROOT_DIR)
+
+FIXTURES = ("small.html", "huge.html", "js_heavy.html")
+
+
+def build_huge_page(sections=10000):
+    """数MBになる大規模なECページを生成する"""
+    items = "".join(
+        f'<div class="item"><h3>商品 {i}</h3><p>{"商品説明 " * 30}</p>'
+        f'<a href="/cart/{i}" class="btn-cart">カートに入れる</a></div>'
+        for i in range(sections)
+    )
+    return (
+        '<!DOCTYPE html><html lang="ja"><head><meta charset="UTF-8">'
+        '<meta name="description" content="ベンチマーク用の大規模ページ"><title>大規模EC - ベンチマーク</title></head>'
+        f'<body><h1>全商品一覧</h1><a href="/signup" class="btn-primary">会員登録</a>{items}</body></html>'
+    )
+
+
+class FixtureHandler(SimpleHTTPRequestHandler):
+    """フィクスチャを配信する。huge.html はメモリ上で生成したものを返す"""
+
+    huge_page = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] == "/huge.html":
+            body = self.huge_page
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """Chat Completions APIを模した偽エンドポイント"""
+
+    latency = 0.5
+    jitter = 0.1
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        body = json.dumps({
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self._content(request)},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 1000, "completion_tokens": 300, "total_tokens": 1300}
+        }, ensure_ascii=False).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _content(self, request):
+        messages = request.get("messages", [])
+        user_content = messages[-1]["content"] if messages else ""
+        has_image = isinstance(user_content, list)
+        text = user_content if isinstance(user_content, str) else json.dumps(user_content, ensure_ascii=False)
+
+        if "改善提案を5つ" in text:
+            return json.dumps([
+                {"title": f"改善案{i}", "description": "説明", "difficulty": "中", "impact": "高", "category": "CTA改善"}
+                for i in range(5)
+            ], ensure_ascii=False)
+
+        analysis = {"strengths": ["強み"], "weaknesses": ["弱み"], "improvement_suggestions": ["改善案"]}
+        response_format = request.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            # デバイスごとの視覚分析をまとめて要求された場合
+            visual = dict(analysis, scores={"visual_hierarchy": 6, "cta_visibility": 6, "responsive_design": 6,
+                                            "color_contrast": 6, "overall_ux": 6})
+            devices = response_format["json_schema"]["schema"]["required"]
+            return json.dumps({device: visual for device in devices}, ensure_ascii=False)
+        if has_image:
+            analysis["scores"] = {"visual_hierarchy": 6, "cta_visibility": 6, "responsive_design": 6,
+                                  "color_contrast": 6, "overall_ux": 6}
+        else:
+            analysis["scores"] = {"value_proposition": 6, "cta_visibility": 6, "user_flow": 6,
+                                  "form_usability": 6, "trust_elements": 6}
+        return json.dumps(analysis, ensure_ascii=False)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentiles(samples):
+    """最近傍順位法によるパーセンタイル"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def rank(p):
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 4),
+        "p50": rank(50),
+        "p90": rank(90),
+        "p95": rank(95),
+        "p99": rank(99),
+        "max": ordered[-1]
+    }
+
+
+def run_benchmark(iterations, concurrency, fixtures):
+    # 計測対象はOpenAI互換サーバーの設定を読んでから読み込む
+    from analyzer import CVRAnalyzer
+    from rule_checker import CVRRuleChecker
+
+    analyzer = CVRAnalyzer()
+    rule_checker = CVRRuleChecker()
+    report = {"fixtures": {}}
+
+    for fixture in fixtures:
+        url = f"{os.environ['CVR_BENCH_FIXTURE_BASE']}/{fixture}"
+        stage_samples = {}
+        errors = 0
+
+        def analyze_once(_):
+            # ルールチェックは分析で読み込んだページを共有する（ページの読み込みは1回だけ）
+            pages = []
+            result = analyzer.analyze_website(url, on_page=pages.append)
+            started = time.perf_counter()
+            rule_checker.check_url(url, page=pages[0] if pages else None)
+            result["timings"]["check_url"] = round(time.perf_counter() - started, 3)
+            return result["timings"]
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(analyze_once, i) for i in range(iterations)]
+            for future in futures:
+                try:
+                    timings = future.result()
+                except Exception as e:
+                    print(f"ベンチマーク実行エラー ({fixture}): {str(e)}", file=sys.stderr)
+                    errors += 1
+                    continue
+                for stage, seconds in timings.items():
+                    stage_samples.setdefault(stage, []).append(seconds)
+        elapsed = time.perf_counter() - started
+
+        completed = iterations - errors
+        report["fixtures"][fixture] = {
+            "iterations": iterations,
+            "errors": errors,
+            "wall_seconds": round(elapsed, 3),
+            "throughput_per_minute": round(completed / elapsed * 60, 2) if elapsed else 0,
+            "stages": {stage: percentiles(samples) for stage, samples in stage_samples.items()}
+        }
+
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CVR分析パイプラインのステージ別ベンチマーク")
+    parser.add_argument("--iterations", type=int, default=5, help="フィクスチャごとの分析回数")
+    parser.add_argument("--concurrency", type=int, default=1, help="同時に実行する分析数")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="偽OpenAIエンドポイントの応答遅延（秒）")
+    parser.add_argument("--llm-jitter", type=float, default=0.1, help="応答遅延のゆらぎ（秒）")
+    parser.add_argument("--fixtures", nargs="+", default=list(FIXTURES), choices=FIXTURES)
+    parser.add_argument("--use-cache", action="store_true", help="LLM応答キャッシュを有効にする")
+    parser.add_argument("--skip-memory", action="store_true", help="Pythonヒープのピークを測る追加の実行を省く")
+    parser.add_argument("-o", "--output", help="結果JSONの出力先（省略時は標準出力）")
+    args = parser.parse_args(argv)
+
+    FixtureHandler.huge_page = build_huge_page().encode("utf-8")
+    fixture_server = start_server(partial(FixtureHandler, directory=FIXTURES_DIR))
+    FakeOpenAIHandler.latency = args.llm_latency
+    FakeOpenAIHandler.jitter = args.llm_jitter
+    openai_server = start_server(FakeOpenAIHandler)
+
+    os.environ["CVR_BENCH_FIXTURE_BASE"] = f"http://127.0.0.1:{fixture_server.server_port}"
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{openai_server.server_port}/v1"
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    os.environ["CVR_LLM_CACHE"] = "1" if args.use_cache else "0"
+    # 前回の結果の再利用（304・DOMの指紋が同じ）を計測しないよう、毎回パイプライン全体を実行する
+    os.environ["CVR_INCREMENTAL"] = "0"
+    # ページの状態・分析結果・スクリーンショット・キャッシュはリポジトリの data/ ではなく一時ディレクトリに書く
+    work_dir = tempfile.mkdtemp(prefix="cvr-bench-")
+    os.environ["CVR_PAGE_STATE_PATH"] = os.path.join(work_dir, "page_state.sqlite3")
+    os.environ["CVR_RESULT_STORE_PATH"] = os.path.join(work_dir, "results.sqlite3")
+    os.environ["CVR_LLM_CACHE_PATH"] = os.path.join(work_dir, "llm_cache.sqlite3")
+    os.environ["CVR_SCREENSHOT_DIR"] = os.path.join(work_dir, "screenshots")
+    os.environ["CVR_SCREENSHOT_INDEX_PATH"] = os.path.join(work_dir, "screenshots.sqlite3")
+    os.environ.setdefault("CVR_BROWSER_POOL_SIZE", str(max(2, args.concurrency)))
+
+    started = time.perf_counter()
+    # 分析中のログ出力が結果のJSONに混ざらないよう標準エラーへ流す
+    with redirect_stdout(sys.stderr):
+        report = run_benchmark(args.iterations, args.concurrency, args.fixtures)
+    total_elapsed = time.perf_counter() - started
+
+    # tracemallocは割り当てのたびにオーバーヘッドがかかるので、レイテンシの計測とは別に
+    # フィクスチャごとに1回ずつ分析してPythonヒープのピークを測る
+    python_peak = None
+    if not args.skip_memory:
+        tracemalloc.start()
+        with redirect_stdout(sys.stderr):
+            run_benchmark(1, 1, args.fixtures)
+        _, python_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    total_runs = sum(f["iterations"] - f["errors"] for f in report["fixtures"].values())
+    report["config"] = {
+        "iterations": args.iterations,
+        "concurrency": args.concurrency,
+        "llm_latency": args.llm_latency,
+        "llm_jitter": args.llm_jitter,
+        "use_cache": args.use_cache
+    }
+    report["summary"] = {
+        "wall_seconds": round(total_elapsed, 3),
+        "analyses": total_runs,
+        "throughput_per_minute": round(total_runs / total_elapsed * 60, 2) if total_elapsed else 0,
+        "peak_python_heap_mb": round(python_peak / (1024 * 1024), 2) if python_peak is not None else None,
+        # Linuxでは ru_maxrss はKB単位（子プロセスのChromeは含まない）
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+    }
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    fixture_server.shutdown()
+    openai_server.shutdown()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
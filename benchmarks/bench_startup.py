@@ -0,0 +1,131 @@
+"""起動時間のベンチマーク
+
+エントリポイント（app / batch / funnel / rule_checker）を新しいPythonプロセスで読み込み、
+`python -X importtime` の出力からモジュールごとの読み込み時間（自身・子を含む累計）を集計する。
+読み込みの所要時間（プロセス起動を含む壁時計時間）の分布と、累計時間の大きいモジュールをJSONで出力する。
+
+使い方:
+    python benchmarks/bench_startup.py --runs 5 --top 15 -o startup.json
+    python benchmarks/bench_startup.py --warm-up    # CVR_WARMUP=1（依存ライブラリを先に読み込む）で計測
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import subprocess
+import statistics
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = ("app", "batch", "funnel", "rule_checker")
+# 遅延読み込みの対象。起動時に読み込まれていれば一覧に出す
+HEAVY_MODULES = ("openai", "selenium.webdriver", "webdriver_manager.chrome", "bs4", "requests", "PIL.Image",
+                 "numpy")
+
+# import time: self [us] | cumulative | imported package
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\| *(\S+)\s*$")
+
+
+def parse_importtime(stderr):
+    """-X importtime の出力をモジュール名 -> {self_ms, cumulative_ms} にする"""
+    modules = {}
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, name = match.groups()
+        modules[name] = {"self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000}
+    return modules
+
+
+def measure(entry_point, env):
+    """新しいプロセスでエントリポイントを読み込み、壁時計時間と -X importtime の集計を返す"""
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {entry_point}"],
+        cwd=ROOT_DIR, env=env, capture_output=True, text=True
+    )
+    elapsed = time.perf_counter() - started
+    if completed.returncode != 0:
+        # 最後の行が例外のメッセージ
+        errors = [line for line in completed.stderr.splitlines() if not line.startswith("import time:")]
+        raise RuntimeError(f"{entry_point} の読み込みに失敗しました: {errors[-1] if errors else completed.returncode}")
+    return elapsed, parse_importtime(completed.stderr)
+
+
+def run_benchmark(entry_points, runs, top, env):
+    report = {}
+    for entry_point in entry_points:
+        wall = []
+        samples = []
+        for _ in range(runs):
+            elapsed, modules = measure(entry_point, env)
+            wall.append(elapsed)
+            samples.append(modules)
+
+        # 実行ごとのばらつきを抑えるため、モジュールごとに中央値をとる
+        names = set().union(*samples)
+        medians = {
+            name: {
+                "self_ms": round(statistics.median(s[name]["self_ms"] for s in samples if name in s), 2),
+                "cumulative_ms": round(statistics.median(s[name]["cumulative_ms"] for s in samples if name in s), 2),
+            }
+            for name in names
+        }
+        entry = medians.get(entry_point, {})
+        report[entry_point] = {
+            "wall_ms": {
+                "median": round(statistics.median(wall) * 1000, 1),
+                "min": round(min(wall) * 1000, 1),
+                "max": round(max(wall) * 1000, 1)
+            },
+            "import_ms": entry.get("cumulative_ms"),
+            "modules": len(names),
+            "heavy_modules_loaded": [name for name in HEAVY_MODULES if name in names],
+            "top_cumulative": _top(medians, "cumulative_ms", top, exclude=entry_point),
+            "top_self": _top(medians, "self_ms", top)
+        }
+    return report
+
+
+def _top(medians, key, count, exclude=None):
+    ranked = sorted(((name, values[key]) for name, values in medians.items() if name != exclude),
+                    key=lambda item: item[1], reverse=True)
+    return [{"module": name, key: value} for name, value in ranked[:count]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="エントリポイントの起動時間（モジュールごとの読み込み時間）のベンチマーク")
+    parser.add_argument("entry_points", nargs="*", default=list(ENTRY_POINTS), help="読み込むモジュール")
+    parser.add_argument("--runs", type=int, default=5, help="エントリポイントごとの計測回数")
+    parser.add_argument("--top", type=int, default=15, help="出力する上位モジュールの数")
+    parser.add_argument("--warm-up", action="store_true", help="CVR_WARMUP=1 で計測する（app のみ有効）")
+    parser.add_argument("-o", "--output", help="結果JSONの出力先（省略時は標準出力）")
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT_DIR, env.get("PYTHONPATH")]))
+    # 計測の前に1回ずつ読み込み、バイトコードのキャッシュを作っておく（コンパイル時間を含めない）
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    if args.warm_up:
+        env["CVR_WARMUP"] = "1"
+    for entry_point in args.entry_points:
+        measure(entry_point, env)
+
+    report = {
+        "entry_points": run_benchmark(args.entry_points, args.runs, args.top, env),
+        "config": {"runs": args.runs, "warm_up": args.warm_up, "python": sys.version.split()[0]}
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
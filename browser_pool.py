@@ -0,0 +1,282 @@
+import os
+import time
+import atexit
+import threading
+import urllib.parse
+from contextlib import contextmanager
+from functools import lru_cache
+from metrics import BROWSER_SESSIONS_OPEN
+import tracing
+
+# デバイスごとのウィンドウサイズとユーザーエージェント（Noneはブラウザ既定のUA）
+DEVICE_PROFILES = {
+    "desktop": {"window_size": (1920, 1080), "user_agent": None},
+    "mobile": {"window_size": (375, 812), "user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 13_2_3 like Mac OS X)"},
+}
+
+
+class BrowserPoolTimeout(Exception):
+    """ブラウザセッションの貸し出し待ちがタイムアウトした"""
+
+
+@lru_cache(maxsize=None)
+def get_driver_path():
+    """ChromeDriverのパスをプロセスごとに一度だけ解決する"""
+    from webdriver_manager.chrome import ChromeDriverManager
+    return ChromeDriverManager().install()
+
+
+class BrowserSession:
+    """プール内の1つのChromeセッション"""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.pages = 0
+        self.created_at = time.time()
+        self.default_user_agent = driver.execute_script("return navigator.userAgent")
+        # 貸し出し中に訪れたオリジン（返却時にストレージを消す対象）
+        self.visited_origins = set()
+
+    def record_visit(self, url):
+        """読み込んだURLと、表示中のページ（リダイレクト後）・iframeのオリジンを記録する"""
+        origin = _origin(url)
+        if origin:
+            self.visited_origins.add(origin)
+        self.visited_origins.update(page_origins(self.driver))
+
+
+class BrowserPool:
+    """ウォーム状態のヘッドレスChromeを貸し出す上限付きプール"""
+
+    def __init__(self, max_size=None, max_pages=None, max_memory_mb=None, checkout_timeout=None):
+        self.max_size = max_size or int(os.getenv("CVR_BROWSER_POOL_SIZE", "2"))
+        # この回数だけ貸し出したセッションは破棄して作り直す
+        self.max_pages = max_pages or int(os.getenv("CVR_BROWSER_MAX_PAGES", "50"))
+        # ブラウザのプロセスツリーのRSSがこの値を超えたら作り直す（0で無効）
+        if max_memory_mb is None:
+            max_memory_mb = int(os.getenv("CVR_BROWSER_MAX_MEMORY_MB", "1024"))
+        self.max_memory_mb = max_memory_mb
+        self.checkout_timeout = checkout_timeout or float(os.getenv("CVR_BROWSER_CHECKOUT_TIMEOUT", "60"))
+
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def session(self, device_type="desktop"):
+        """セッションを借りてドライバーを返し、終了時にプールへ戻す"""
+        session = self.checkout(device_type)
+        healthy = False
+        try:
+            yield session.driver
+            healthy = True
+        finally:
+            self.checkin(session, discard=not healthy)
+
+    def checkout(self, device_type="desktop", timeout=None):
+        """空いているセッションを取得する。上限に達している場合は返却を待つ"""
+        timeout = self.checkout_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("ブラウザプールは終了しています")
+                if self._idle:
+                    # 直近に使われた（最もウォームな）セッションから使う
+                    session = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    session = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise BrowserPoolTimeout(f"ブラウザセッションの取得が{timeout}秒でタイムアウトしました")
+                self._condition.wait(remaining)
+
+        if session is None:
+            try:
+                session = BrowserSession(self._launch())
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self._condition.notify()
+                raise
+
+        try:
+            self._apply_profile(session, device_type)
+        except Exception:
+            self._discard(session)
+            raise
+        session.pages += 1
+        return session
+
+    def checkin(self, session, discard=False):
+        """セッションをリセットしてプールへ戻す。不要なら破棄する"""
+        if not discard and self._needs_recycle(session):
+            discard = True
+        if not discard:
+            try:
+                self._reset(session)
+            except Exception as e:
+                print(f"ブラウザセッションのリセットに失敗: {str(e)}")
+                discard = True
+
+        if discard or self._closed:
+            self._discard(session)
+            return
+
+        with self._condition:
+            self._idle.append(session)
+            self._condition.notify()
+
+    def close_all(self):
+        """待機中のセッションをすべて終了する"""
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for session in idle:
+            self._discard(session)
+
+    @property
+    def size(self):
+        """起動済み（貸し出し中を含む）のセッション数"""
+        return self._size
+
+    def _launch(self):
+        # ブラウザを使わないプロセス（テキストのみの分析・お問い合わせの受付）では読み込まない
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+        from selenium.webdriver.chrome.service import Service
+
+        options = Options()
+        options.add_argument("--headless")
+        width, height = DEVICE_PROFILES["desktop"]["window_size"]
+        options.add_argument(f"--window-size={width},{height}")
+        service = Service(get_driver_path())
+        with tracing.span("browser_launch"):
+            return webdriver.Chrome(service=service, options=options)
+
+    def _apply_profile(self, session, device_type):
+        profile = DEVICE_PROFILES.get(device_type, DEVICE_PROFILES["desktop"])
+        session.driver.set_window_size(*profile["window_size"])
+        user_agent = profile["user_agent"] or session.default_user_agent
+        session.driver.execute_cdp_cmd("Network.setUserAgentOverride", {"userAgent": user_agent})
+
+    def _reset(self, session):
+        """次の利用者に状態が漏れないよう、ストレージとタブを初期化する"""
+        driver = session.driver
+        handles = driver.window_handles
+        for handle in handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(handles[0])
+        try:
+            driver.execute_script("window.sessionStorage.clear();")
+        except Exception:
+            # about:blankなどストレージにアクセスできないページ
+            pass
+        # delete_all_cookies や localStorage.clear() は表示中のページのオリジンにしか効かない。
+        # Cookieはすべてのドメインの分をCDPで消し、localStorage・IndexedDBなどは、貸し出し中に
+        # 訪れたオリジン・表示中のページとiframeのオリジン・Cookieを持っていたドメインのオリジンごとに消す
+        origins = set(session.visited_origins) | page_origins(driver)
+        for cookie in driver.execute_cdp_cmd("Network.getAllCookies", {}).get("cookies", []):
+            domain = cookie.get("domain", "").lstrip(".")
+            if domain:
+                origins.update((f"https://{domain}", f"http://{domain}"))
+        driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+        for origin in origins:
+            driver.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+        session.visited_origins.clear()
+        driver.get("about:blank")
+
+    def _needs_recycle(self, session):
+        if session.pages >= self.max_pages:
+            return True
+        if self.max_memory_mb and _process_tree_rss_mb(session.driver) > self.max_memory_mb:
+            print(f"ブラウザのメモリ使用量が上限を超えたため再起動します: {self.max_memory_mb}MB")
+            return True
+        return False
+
+    def _discard(self, session):
+        try:
+            session.driver.quit()
+        except Exception as e:
+            print(f"ブラウザ終了エラー: {str(e)}")
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+
+def page_origins(driver):
+    """表示中のページとそのiframeのオリジン（http / https のみ）"""
+    try:
+        stack = [driver.execute_cdp_cmd("Page.getFrameTree", {})["frameTree"]]
+    except Exception:
+        return set()
+    origins = set()
+    while stack:
+        node = stack.pop()
+        frame = node.get("frame", {})
+        origin = _origin(frame.get("url"))
+        if origin:
+            origins.add(origin)
+        stack.extend(node.get("childFrames", []))
+    return origins
+
+
+def _origin(url):
+    parts = urllib.parse.urlsplit(url or "")
+    if parts.scheme not in ("http", "https") or not parts.netloc:
+        return None
+    return f"{parts.scheme}://{parts.netloc.lower()}"
+
+
+def _process_tree_rss_mb(driver):
+    """ChromeDriverとその子プロセス（Chrome本体・レンダラー）のRSS合計をMB単位で返す
+
+    /procを読めない環境では0を返す。
+    """
+    try:
+        root_pid = driver.service.process.pid
+        children = {}
+        rss = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    # comm にスペースが含まれることがあるため、最後の ')' 以降を分割する
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            pid = int(entry)
+            children.setdefault(int(fields[1]), []).append(pid)
+            rss[pid] = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+
+        total = 0
+        stack = [root_pid]
+        while stack:
+            pid = stack.pop()
+            total += rss.get(pid, 0)
+            stack.extend(children.get(pid, []))
+        return total / (1024 * 1024)
+    except Exception:
+        return 0
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_browser_pool():
+    """プロセス共有のブラウザプールを返す"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BrowserPool()
+            atexit.register(_pool.close_all)
+            BROWSER_SESSIONS_OPEN.set_function(lambda: _pool.size)
+        return _pool
@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import secrets
+import argparse
+import threading
+from url_utils import normalize_url
+
+DEFAULT_CONTACT_PATH = os.path.join(os.path.dirname(__file__), "data", "contacts.sqlite3")
+# Crockford's Base32（IDの文字列順が生成順と一致する）
+_ID_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+EXPORT_FIELDS = ("id", "timestamp", "analyzed_url", "company", "name", "email", "phone", "message", "interests")
+
+
+class ContactIdGenerator:
+    """時刻順に並ぶ衝突しないIDを生成する（ULID形式: 48bitのミリ秒時刻 + 80bitの乱数）
+
+    同じミリ秒内では乱数部を1ずつ増やすので、同一プロセス内では必ず単調増加する。
+    timestamp（UNIX時刻）を指定した場合はその時刻のIDを作る（以前のデータの取り込み用。単調増加はしない）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._last_random = 0
+
+    def new_id(self, timestamp=None):
+        if timestamp is not None:
+            return _encode_id((int(timestamp * 1000) << 80) | secrets.randbits(80))
+        with self._lock:
+            now_ms = int(time.time() * 1000)
+            if now_ms <= self._last_ms:
+                now_ms = self._last_ms
+                self._last_random += 1
+            else:
+                self._last_random = secrets.randbits(80)
+            self._last_ms = now_ms
+            value = (now_ms << 80) | (self._last_random & ((1 << 80) - 1))
+        return _encode_id(value)
+
+
+def _encode_id(value):
+    return "".join(_ID_ALPHABET[(value >> shift) & 31] for shift in range(125, -1, -5))
+
+
+class ContactStore:
+    """お問い合わせを追記専用で保存し、時刻・メールアドレス・分析URLで検索できるようにするストア
+
+    書き込みは専用のスレッドがまとめて1トランザクションでコミットする（グループコミット）。
+    add() はコミットが完了するまで待ってからIDを返すので、応答した時点で保存は確定している。
+    """
+
+    def __init__(self, path=None, batch_size=None, flush_interval=None):
+        self.path = path or os.getenv("CVR_CONTACT_STORE_PATH", DEFAULT_CONTACT_PATH)
+        self.batch_size = batch_size or int(os.getenv("CVR_CONTACT_BATCH_SIZE", "100"))
+        # 最初の1件を受け取ってから、同じバッチに含める後続を待つ秒数
+        self.flush_interval = flush_interval if flush_interval is not None else float(os.getenv("CVR_CONTACT_FLUSH_INTERVAL", "0.05"))
+        self.ids = ContactIdGenerator()
+
+        self._lock = threading.Lock()
+        self._conn = None
+        self._queue = queue.Queue()
+        self._writer = None
+
+    def add(self, contact, timeout=10, created_at=None):
+        """お問い合わせを保存してIDを返す
+
+        created_at（UNIX時刻）を省略すると現在時刻で保存する。IDもこの時刻から作るので、
+        一覧・エクスポートの順序と since / until の絞り込みは created_at に従う。
+        """
+        if created_at is None:
+            contact_id = self.ids.new_id()
+            created_at = time.time()
+        else:
+            contact_id = self.ids.new_id(created_at)
+        pending = _PendingWrite(contact_id, contact, created_at)
+        self._start_writer()
+        self._queue.put(pending)
+        if not pending.done.wait(timeout):
+            raise TimeoutError("お問い合わせの保存が時間内に完了しませんでした")
+        if pending.error is not None:
+            raise pending.error
+        return contact_id
+
+    def query(self, email=None, url=None, since=None, until=None, limit=50, cursor=None):
+        """条件に合うお問い合わせを新しい順に返す
+
+        cursor には前のページの next_cursor を渡す（IDによるキーセットページング）。
+        since / until はUNIX時刻（秒）。
+        """
+        where, params = _filters(email, url, since, until)
+        if cursor:
+            where.append("id < ?")
+            params.append(cursor)
+        sql = "SELECT contact_json FROM contacts"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id DESC LIMIT ?"
+        params.append(limit + 1)
+
+        with self._lock:
+            rows = self._connect().execute(sql, params).fetchall()
+        contacts = [json.loads(row[0]) for row in rows[:limit]]
+        next_cursor = contacts[-1]["id"] if len(rows) > limit else None
+        return {"contacts": contacts, "next_cursor": next_cursor}
+
+    def export(self, email=None, url=None, since=None, until=None, chunk_size=1000):
+        """条件に合うお問い合わせを古い順に1件ずつ返すジェネレーター
+
+        書き込みを止めないよう、エクスポートごとに読み取り専用の接続を開き、
+        chunk_size 件ずつ読み込む。
+        """
+        where, params = _filters(email, url, since, until)
+        sql = "SELECT contact_json FROM contacts"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id"
+
+        with self._lock:
+            self._connect()
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield json.loads(row[0])
+        finally:
+            conn.close()
+
+    def import_json_files(self, directory):
+        """以前の data/contacts/*.json を取り込む。取り込んだ件数を返す
+
+        保存日時とIDはレコードの timestamp（なければファイルの更新日時）から作る。
+        読み込めないファイル（空・JSONとして不正）は報告して読み飛ばす。
+        """
+        count = 0
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(".json"):
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    contact = json.load(f)
+                if not isinstance(contact, dict):
+                    raise ValueError("お問い合わせのオブジェクトではありません")
+            except (OSError, ValueError) as e:
+                print(f"読み込めないファイルを読み飛ばします ({filename}): {str(e)}")
+                continue
+            self.add(contact, created_at=_legacy_created_at(contact, path))
+            count += 1
+        return count
+
+    def close(self):
+        """未処理の書き込みを反映してから書き込みスレッドを止める"""
+        with self._lock:
+            writer = self._writer
+        if writer is not None:
+            self._queue.put(None)
+            writer.join()
+            with self._lock:
+                self._writer = None
+
+    def _start_writer(self):
+        with self._lock:
+            if self._writer is not None:
+                return
+            self._writer = threading.Thread(target=self._write_loop, name="contact-writer", daemon=True)
+            self._writer.start()
+        atexit.register(self.close)
+
+    def _write_loop(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    pending = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if pending is None:
+                    stop = True
+                    break
+                batch.append(pending)
+
+            self._write_batch(batch)
+            if stop:
+                return
+
+    def _write_batch(self, batch):
+        rows = []
+        for pending in batch:
+            record = dict(pending.contact, id=pending.contact_id)
+            analyzed_url = record.get("analyzed_url") or ""
+            rows.append((
+                pending.contact_id,
+                pending.created_at,
+                (record.get("email") or "").strip().lower(),
+                analyzed_url,
+                normalize_url(analyzed_url) if analyzed_url.startswith(("http://", "https://")) else analyzed_url,
+                json.dumps(record, ensure_ascii=False)
+            ))
+
+        error = None
+        try:
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    conn.executemany(
+                        "INSERT INTO contacts (id, created_at, email, analyzed_url, normalized_url, contact_json) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        rows
+                    )
+        except Exception as e:
+            print(f"お問い合わせの保存エラー: {str(e)}")
+            error = e
+
+        for pending in batch:
+            pending.error = error
+            pending.done.set()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS contacts ("
+                "id TEXT PRIMARY KEY, created_at REAL, email TEXT, analyzed_url TEXT, "
+                "normalized_url TEXT, contact_json TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_contacts_created_at ON contacts (created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_contacts_email ON contacts (email, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_contacts_url ON contacts (normalized_url, id)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+
+class _PendingWrite:
+    def __init__(self, contact_id, contact, created_at):
+        self.contact_id = contact_id
+        self.contact = contact
+        self.created_at = created_at
+        self.done = threading.Event()
+        self.error = None
+
+
+def _legacy_created_at(contact, path):
+    """以前のJSONファイルのお問い合わせの保存日時（timestamp はサーバーのローカル時刻）"""
+    try:
+        return time.mktime(time.strptime(contact.get("timestamp") or "", "%Y-%m-%d %H:%M:%S"))
+    except (TypeError, ValueError):
+        return os.path.getmtime(path)
+
+
+def _filters(email, url, since, until):
+    where = []
+    params = []
+    if email:
+        where.append("email = ?")
+        params.append(email.strip().lower())
+    if url:
+        where.append("normalized_url = ?")
+        params.append(normalize_url(url))
+    if since is not None:
+        where.append("created_at >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("created_at < ?")
+        params.append(until)
+    return where, params
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以前のJSONファイルのお問い合わせをストアに取り込む")
+    parser.add_argument("directory", nargs="?", default=os.path.join(os.path.dirname(__file__), "data", "contacts"),
+                        help="お問い合わせのJSONファイルがあるディレクトリ")
+    args = parser.parse_args()
+
+    store = ContactStore()
+    count = store.import_json_files(args.directory)
+    store.close()
+    print(f"{count}件のお問い合わせを取り込みました: {store.path}")
+
+
+if __name__ == "__main__":
+    main()
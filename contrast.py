@@ -0,0 +1,116 @@
+import numpy as np
+from PIL import Image
+from screenshot_store import screenshot_file_path
+
+# sRGBの各値(0-255)から線形化した値への変換表（WCAG 2.x の相対輝度の定義）
+_SRGB = np.arange(256, dtype=np.float64) / 255
+SRGB_TO_LINEAR = np.where(_SRGB <= 0.03928, _SRGB / 12.92, ((_SRGB + 0.055) / 1.055) ** 2.4).astype(np.float32)
+LUMINANCE_WEIGHTS = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+# チャンネルごとに重みを掛けておいた変換表（画素数×3の浮動小数点配列を作らずに済む）
+_WEIGHTED_LUTS = [SRGB_TO_LINEAR * weight for weight in LUMINANCE_WEIGHTS]
+
+# 背景色を推定するときの色の量子化（各チャンネル上位4ビット）
+_QUANTIZE_SHIFT = 4
+
+
+def relative_luminance(pixels):
+    """RGB配列（末尾の次元が3、uint8）の相対輝度を一括で計算する"""
+    red, green, blue = _WEIGHTED_LUTS
+    return red[pixels[..., 0]] + green[pixels[..., 1]] + blue[pixels[..., 2]]
+
+
+def contrast_ratio(luminance1, luminance2):
+    """相対輝度どうしのコントラスト比（配列どうしでも計算できる）"""
+    lighter = np.maximum(luminance1, luminance2)
+    darker = np.minimum(luminance1, luminance2)
+    return (lighter + 0.05) / (darker + 0.05)
+
+
+def color_contrast(color1, color2):
+    """2つのRGB値のコントラスト比"""
+    luminance = relative_luminance(np.array([color1, color2], dtype=np.uint8))
+    return round(float(contrast_ratio(luminance[0], luminance[1])), 2)
+
+
+def measure_contrast(image, boxes, scale=1.0, foreground_share=0.8):
+    """スクリーンショット上の要素領域ごとに、実際に描画された前景色・背景色とコントラスト比を求める
+
+    image はPILの画像かファイルパス、boxes は {"x", "y", "width", "height"}（CSSピクセル）のリスト。
+    scale はCSSピクセルから画像のピクセルへの倍率（devicePixelRatio）。
+    輝度と色の量子化は各領域を切り出してから計算する（画像全体の配列は作らない）。
+    領域で最も多い色を背景とし、背景との輝度差が最大値の foreground_share 倍以上ある画素を
+    前景（文字の中心部分。アンチエイリアスの中間色は除く）とみなす。
+    画像の外にある領域や、単色の領域（前景がない）は None を返す。
+    """
+    if not isinstance(image, Image.Image):
+        with Image.open(image) as opened:
+            return measure_contrast(opened, boxes, scale, foreground_share)
+
+    width, height = image.size
+    results = []
+    for box in boxes:
+        left = max(0, int(box["x"] * scale))
+        top = max(0, int(box["y"] * scale))
+        right = min(width, int((box["x"] + box["width"]) * scale))
+        bottom = min(height, int((box["y"] + box["height"]) * scale))
+        if right - left < 2 or bottom - top < 2:
+            results.append(None)
+            continue
+        # フルページの画像は数千万画素になるので、輝度・量子化色は領域を切り出してから計算する
+        region = image.crop((left, top, right, bottom)).convert("RGB")
+        results.append(_measure_region(np.asarray(region).reshape(-1, 3), foreground_share))
+    return results
+
+
+def _measure_region(region_pixels, foreground_share):
+    """領域の画素（N×3、uint8）から前景色・背景色とコントラスト比を求める"""
+    region_luminance = relative_luminance(region_pixels)
+    # 量子化した色を1つの整数にまとめ、最頻色を bincount で求める
+    bits = 8 - _QUANTIZE_SHIFT
+    quantized = (region_pixels >> _QUANTIZE_SHIFT).astype(np.int32)
+    region_packed = (quantized[:, 0] << (2 * bits)) | (quantized[:, 1] << bits) | quantized[:, 2]
+
+    background_mask = region_packed == np.bincount(region_packed).argmax()
+    background_luminance = float(np.median(region_luminance[background_mask]))
+
+    distance = np.abs(region_luminance - background_luminance)
+    max_distance = distance.max()
+    if max_distance <= 0:
+        return None
+    foreground_mask = (distance >= max_distance * foreground_share) & ~background_mask
+    if not foreground_mask.any():
+        return None
+
+    foreground_luminance = float(np.median(region_luminance[foreground_mask]))
+    return {
+        "ratio": round(float(contrast_ratio(foreground_luminance, background_luminance)), 2),
+        "foreground": tuple(int(c) for c in np.median(region_pixels[foreground_mask], axis=0)),
+        "background": tuple(int(c) for c in np.median(region_pixels[background_mask], axis=0))
+    }
+
+
+def measure_page_contrast(page, device_type="desktop"):
+    """ページのスクリーンショットから、CTAとテキストブロックのコントラストをまとめて測定する
+
+    戻り値は {"ctas": [...], "texts": [...]}。各要素はDOMスナップショットの要素に
+    "contrast"（measure_contrast の結果）を加えたもの。スクリーンショットがなければ None。
+    """
+    screenshot = page.screenshots.get(device_type)
+    if not screenshot or page.dom_snapshot is None:
+        return None
+
+    groups = {
+        "ctas": [cta for cta in page.dom_snapshot["ctas"] if cta["visible"]],
+        "texts": [text for text in page.dom_snapshot.get("texts", []) if text["visible"]]
+    }
+    elements = groups["ctas"] + groups["texts"]
+    measured = measure_contrast(screenshot_file_path(screenshot), [element["bbox"] for element in elements],
+                                scale=page.dom_snapshot["viewport"].get("device_pixel_ratio") or 1.0)
+
+    results = {}
+    offset = 0
+    for name, group in groups.items():
+        results[name] = [dict(element, contrast=contrast)
+                         for element, contrast in zip(group, measured[offset:offset + len(group)])]
+        offset += len(group)
+    return results
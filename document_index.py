@@ -0,0 +1,80 @@
+import os
+from importlib.util import find_spec
+
+# lxmlがあれば高速なCパーサーを使い、なければ標準のhtml.parserにフォールバックする
+# （起動を速くするため、bs4とともに実際に解析するまで読み込まない）
+DEFAULT_PARSER = "lxml" if find_spec("lxml") is not None else "html.parser"
+
+HEADING_TAGS = ("h1", "h2", "h3", "h4", "h5", "h6")
+FIELD_TAGS = ("input", "textarea", "select")
+# 入力項目として数えないinputのtype
+NON_INPUT_TYPES = ("hidden", "submit", "button")
+
+
+def is_cta(element):
+    """class名に btn / button / cta を含む a・button 要素をCTAとみなす"""
+    if element.name not in ("a", "button"):
+        return False
+    classes = element.get("class") or []
+    if isinstance(classes, str):
+        classes = classes.split()
+    return any(keyword in c.lower() for c in classes for keyword in ("btn", "button", "cta"))
+
+
+class DocumentIndex:
+    """1ページ分のHTMLを1回だけ解析し、各分析が参照する要素の索引を持つ
+
+    テキスト分析とルールチェックはこの索引を参照するだけで、木の再走査は行わない。
+    """
+
+    def __init__(self, html, parser=None):
+        from bs4 import BeautifulSoup
+
+        self.parser = parser or os.getenv("CVR_HTML_PARSER", DEFAULT_PARSER)
+        self.soup = BeautifulSoup(html or "", self.parser)
+
+        # (タグ名, テキスト) のリスト（文書順）
+        self.headings = []
+        self.ctas = []
+        self.forms = []
+        self.fields = []
+        # name または property -> content
+        self.meta = {}
+        self.title = None
+
+        # 木を1回だけ走査して索引を作る
+        for element in self.soup.find_all(True):
+            name = element.name
+            if name in HEADING_TAGS:
+                self.headings.append((name, element.get_text().strip()))
+            elif name == "form":
+                self.forms.append(element)
+            elif name in FIELD_TAGS:
+                self.fields.append(element)
+            elif name == "meta":
+                key = element.get("name") or element.get("property")
+                if key and element.get("content") is not None:
+                    self.meta.setdefault(key.lower(), element["content"])
+            elif name == "title" and self.title is None:
+                self.title = element.string
+
+            if is_cta(element):
+                self.ctas.append(element)
+
+        # フォームごとの入力項目（hidden・submit・buttonを除く）
+        self.form_fields = [
+            [field for field in form.find_all(FIELD_TAGS) if field.get("type") not in NON_INPUT_TYPES]
+            for form in self.forms
+        ]
+
+    @property
+    def description(self):
+        return self.meta.get("description")
+
+    def heading_texts(self, levels=("h1", "h2", "h3")):
+        """指定レベルの見出しテキストを文書順で返す"""
+        return [text for name, text in self.headings if name in levels]
+
+    def cta_texts(self, tags=("a", "button")):
+        """CTA要素のテキストを文書順で返す"""
+        return [element.get_text().strip() for element in self.ctas if element.name in tags]
@@ -0,0 +1,292 @@
+"""CTAとフォームの遷移先をたどり、コンバージョンまでの導線（ファネル）全体を分析するツール
+
+使い方:
+    python funnel.py https://example.com/ -o funnel.json --max-depth 3 --max-pages 10 --concurrency 2
+
+開始ページからCTA・フォームの遷移先を幅優先でたどり、各ページを analyze_website で分析して
+ページごとのスコアとファネル全体の集計を出力する。ブラウザセッション（ブラウザプール）と
+HTTPの接続（共有HTTPクライアント）はすべてのページで共有する。
+"""
+import re
+import sys
+import json
+import time
+import argparse
+import traceback
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import redirect_stdout
+from analyzer import CVRAnalyzer
+from document_index import DocumentIndex
+from page_loader import fetch_html
+from render_detector import RENDER_MODES
+from url_utils import normalize_url
+
+# CTAのclass名がなくても、コンバージョンへの導線とみなすリンクの文言・パス
+FUNNEL_LINK_PATTERN = re.compile(
+    r"申し?込|問い?合わ?せ|資料|請求|無料|体験|購入|カート|予約|登録|見積|相談|料金|プラン|価格|"
+    r"contact|inquiry|signup|sign-up|register|trial|demo|pricing|plans?|checkout|cart|buy|order|quote",
+    re.IGNORECASE
+)
+# GETでも状態を変えうるURL（カートへの追加・購入の確定・ログアウトなど）。遷移として記録するがたどらない
+MUTATION_PATH_PATTERN = re.compile(
+    r"add[-_]?to[-_]?cart|[?&](?:add[-_]to[-_]cart|quantity|qty)=|"
+    r"/cart/(?:add|remove|update|delete|clear|\d+)(?:[/?]|$)|/(?:buy|order|purchase)(?:[/?]|$)|"
+    r"/(?:logout|log-out|signout|sign-out|unsubscribe|delete|remove)(?:[/?]|$)",
+    re.IGNORECASE
+)
+# ページとして分析しないファイルの拡張子
+SKIP_EXTENSIONS = (".pdf", ".zip", ".jpg", ".jpeg", ".png", ".gif", ".webp", ".svg", ".mp4", ".mp3",
+                   ".xls", ".xlsx", ".doc", ".docx", ".ppt", ".pptx", ".csv")
+
+
+def discover_targets(document, base_url, same_host=True):
+    """ページからCTA・フォームの遷移先を文書順に取り出す
+
+    戻り値は {"url": 正規化したURL, "kind": "cta" / "link" / "form", "text": 文言, "follow": たどるか}
+    のリスト（重複なし）。GET以外のフォームの送信先と、状態を変えうるURL（MUTATION_PATH_PATTERN）は
+    follow=False（遷移として記録するが、GETで訪問しない）。
+    same_host=True の場合、開始ページと別のホストへの遷移先は除く。
+    """
+    base_host = _site_host(base_url)
+    candidates = [("cta", element.get("href"), element.get_text(" ", strip=True), True)
+                  for element in document.ctas if element.name == "a"]
+    for element in document.soup.find_all("a", href=True):
+        text = element.get_text(" ", strip=True)
+        if FUNNEL_LINK_PATTERN.search(text) or FUNNEL_LINK_PATTERN.search(element["href"]):
+            candidates.append(("link", element["href"], text, True))
+    for form in document.forms:
+        submit = form.find(["button", "input"], type="submit")
+        text = (submit.get("value") or submit.get_text(" ", strip=True)) if submit is not None else ""
+        # POSTなどのフォームは送信するとデータが登録されるので、送信先を訪問しない
+        is_get = (form.get("method") or "get").strip().lower() == "get"
+        candidates.append(("form", form.get("action"), text, is_get))
+
+    targets = []
+    seen = {normalize_url(base_url)}
+    for kind, href, text, follow in candidates:
+        href = (href or "").strip()
+        if not href or href.startswith(("#", "javascript:", "mailto:", "tel:")):
+            continue
+        url = urllib.parse.urljoin(base_url, href)
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https") or parts.path.lower().endswith(SKIP_EXTENSIONS):
+            continue
+        if same_host and _site_host(url) != base_host:
+            continue
+        url = normalize_url(url)
+        if url in seen:
+            continue
+        seen.add(url)
+        follow = follow and not MUTATION_PATH_PATTERN.search(parts.path + ("?" + parts.query if parts.query else ""))
+        targets.append({"url": url, "kind": kind, "text": text[:100], "follow": follow})
+    return targets
+
+
+class FunnelCrawler:
+    """開始ページからCTA・フォームの遷移先を幅優先でたどって各ページを分析する
+
+    同時に分析するページ数は concurrency までに抑え、深さ max_depth・ページ数 max_pages で打ち切る。
+    URLは正規化してから重複を除くので、末尾のスラッシュやクエリの順序の違いで同じページを二度分析しない。
+    """
+
+    def __init__(self, analyzer=None, max_depth=None, max_pages=None, concurrency=None, render_mode=None,
+                 same_host=True, force=False):
+        self.analyzer = analyzer or CVRAnalyzer()
+        self.max_depth = max_depth if max_depth is not None else 3
+        self.max_pages = max_pages or 10
+        self.concurrency = concurrency or 2
+        self.render_mode = render_mode
+        self.same_host = same_host
+        self.force = force
+
+    def crawl(self, start_url):
+        """ファネルをたどって分析し、ページごとの結果と全体の集計を返す"""
+        start_url = normalize_url(start_url)
+        started = time.perf_counter()
+        # URL -> ページの記録（発見した順）
+        pages = {start_url: {"url": start_url, "depth": 0, "parent": None, "via": None}}
+        edges = []
+        finished = 0
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            running = {executor.submit(self._visit, pages[start_url]): start_url}
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url = running.pop(future)
+                    page = pages[url]
+                    targets = future.result()
+                    finished += 1
+                    print(f"[{finished}/{len(pages)}] {page['status']}: {url}（遷移先 {len(targets)}件）",
+                          file=sys.stderr)
+
+                    for target in targets:
+                        edges.append({"from": url, "to": target["url"], "kind": target["kind"],
+                                      "text": target["text"], "followed": target["follow"]})
+                        if (not target["follow"] or target["url"] in pages or page["depth"] >= self.max_depth
+                                or len(pages) >= self.max_pages):
+                            continue
+                        child = {"url": target["url"], "depth": page["depth"] + 1, "parent": url,
+                                 "via": {"kind": target["kind"], "text": target["text"]}}
+                        pages[target["url"]] = child
+                        running[executor.submit(self._visit, child)] = target["url"]
+
+        report = aggregate_funnel(start_url, list(pages.values()), edges)
+        report["elapsed"] = round(time.perf_counter() - started, 3)
+        return report
+
+    def _visit(self, page):
+        """1ページを分析し、ページの記録を埋めて遷移先を返す"""
+        documents = []
+
+        def on_page(artifacts):
+            # レンダリング後のDOMがあればそれを使うので、JavaScriptで描画されるリンクも拾える
+            documents.append(artifacts.document)
+
+        started = time.perf_counter()
+        try:
+            result = self.analyzer.analyze_website(page["url"], force=self.force, render_mode=self.render_mode,
+                                                   on_page=on_page)
+            page["status"] = "ok"
+            page["result_id"] = result.get("id")
+            page["overall_score"] = result.get("overall_score")
+            page["category_scores"] = result.get("category_scores", {})
+            page["render_mode"] = result.get("render_mode")
+            page["weaknesses"] = result.get("weaknesses", [])
+        except Exception as e:
+            traceback.print_exc()
+            page["status"] = "error"
+            page["error"] = str(e)
+            return []
+        finally:
+            page["elapsed"] = round(time.perf_counter() - started, 3)
+
+        try:
+            if documents:
+                document = documents[0]
+            else:
+                # 前回の結果を再利用した（304）場合はページを読み込んでいないので、HTMLだけ取得する
+                document = DocumentIndex(fetch_html(page["url"]).html)
+            page["forms"] = len(document.forms)
+            page["ctas"] = len(document.ctas)
+            return discover_targets(document, page["url"], self.same_host)
+        except Exception as e:
+            print(f"遷移先の抽出エラー ({page['url']}): {str(e)}")
+            page["forms"] = 0
+            page["ctas"] = 0
+            return []
+
+
+def aggregate_funnel(start_url, pages, edges):
+    """ページごとの分析結果からファネル全体の集計を作る
+
+    - 深さ（ステップ）ごとの平均スコア
+    - カテゴリごとの平均スコアと、最もスコアの低いページ
+    - 最初にフォームがあるページまでの経路
+    - CTAもフォームもなく、導線が途切れているページ
+    """
+    analyzed = [page for page in pages if page.get("status") == "ok"]
+    scored = [page for page in analyzed if isinstance(page.get("overall_score"), (int, float))]
+
+    steps = []
+    for depth in sorted({page["depth"] for page in analyzed}):
+        step_pages = [page for page in scored if page["depth"] == depth]
+        steps.append({
+            "depth": depth,
+            "pages": [page["url"] for page in analyzed if page["depth"] == depth],
+            "average_score": _average(page["overall_score"] for page in step_pages)
+        })
+
+    categories = {}
+    for page in scored:
+        for category, score in page.get("category_scores", {}).items():
+            if isinstance(score, (int, float)):
+                categories.setdefault(category, []).append((score, page["url"]))
+    category_scores = {
+        category: {
+            "average": _average(score for score, _ in values),
+            "weakest": {"url": min(values)[1], "score": min(values)[0]}
+        }
+        for category, values in categories.items()
+    }
+
+    by_url = {page["url"]: page for page in pages}
+    form_pages = sorted((page for page in analyzed if page.get("forms")), key=lambda page: page["depth"])
+    path_to_form = None
+    if form_pages:
+        path_to_form = []
+        page = form_pages[0]
+        while page is not None:
+            path_to_form.insert(0, {"url": page["url"], "via": page["via"]})
+            page = by_url.get(page["parent"])
+
+    outgoing = {edge["from"] for edge in edges}
+    dead_ends = [page["url"] for page in analyzed
+                 if not page.get("forms") and page["url"] not in outgoing]
+    weakest = min(scored, key=lambda page: page["overall_score"]) if scored else None
+
+    return {
+        "start_url": start_url,
+        "summary": {
+            "pages": len(pages),
+            "analyzed": len(analyzed),
+            "errors": sum(1 for page in pages if page.get("status") == "error"),
+            "max_depth": max((page["depth"] for page in analyzed), default=0),
+            "overall_score": _average(page["overall_score"] for page in scored),
+            "weakest_page": {"url": weakest["url"], "score": weakest["overall_score"]} if weakest else None,
+            "form_pages": [page["url"] for page in form_pages]
+        },
+        "steps": steps,
+        "category_scores": category_scores,
+        "path_to_form": path_to_form,
+        "dead_ends": dead_ends,
+        "pages": pages,
+        "edges": edges
+    }
+
+
+def _average(values):
+    values = list(values)
+    return round(sum(values) / len(values), 1) if values else None
+
+
+def _site_host(url):
+    """比較用のホスト名（先頭の www. は同一サイトとして扱う）"""
+    host = (urllib.parse.urlsplit(url).hostname or "").lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CTA・フォームの遷移先をたどってファネル全体をCVR分析する")
+    parser.add_argument("url", help="ファネルの開始ページ（ランディングページなど）のURL")
+    parser.add_argument("-o", "--output", help="レポートJSONの出力先（省略時は標準出力）")
+    parser.add_argument("--max-depth", type=int, default=3, help="開始ページからたどる遷移の回数の上限")
+    parser.add_argument("--max-pages", type=int, default=10, help="分析するページ数の上限")
+    parser.add_argument("-c", "--concurrency", type=int, default=2, help="同時に分析するページ数")
+    parser.add_argument("--mode", choices=RENDER_MODES, help="レンダリングモード（auto: 必要なページだけブラウザを使う）")
+    parser.add_argument("--all-hosts", action="store_true", help="別のホストへの遷移先もたどる")
+    parser.add_argument("--force", action="store_true", help="前回の分析結果を再利用せずに再分析する")
+    args = parser.parse_args(argv)
+
+    url = args.url if args.url.startswith(("http://", "https://")) else "https://" + args.url
+    crawler = FunnelCrawler(max_depth=args.max_depth, max_pages=args.max_pages, concurrency=args.concurrency,
+                            render_mode=args.mode, same_host=not args.all_hosts, force=args.force)
+    # 分析中のログ出力がレポートのJSONに混ざらないよう標準エラーへ流す
+    with redirect_stdout(sys.stderr):
+        report = crawler.crawl(url)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+    summary = report["summary"]
+    print(f"完了: {summary['analyzed']}ページを分析（エラー {summary['errors']}件、{report['elapsed']}秒）",
+          file=sys.stderr)
+    return 0 if summary["analyzed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
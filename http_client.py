@@ -0,0 +1,120 @@
+import os
+import re
+import threading
+from importlib.util import find_spec
+
+DEFAULT_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+_CHUNK_SIZE = 64 * 1024
+
+# urllib3はbrotliがインストールされている場合だけbrの展開に対応する
+ACCEPT_ENCODING = "gzip, deflate, br" if find_spec("brotli") is not None else "gzip, deflate"
+# <meta charset="..."> と <meta http-equiv="Content-Type" content="...; charset=..."> の両方に一致する
+META_CHARSET_PATTERN = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([A-Za-z0-9_.:-]+)""", re.IGNORECASE)
+
+
+class ResponseTooLarge(Exception):
+    """レスポンスの本文が上限のバイト数を超えた"""
+
+
+class HTTPResponse:
+    """上限までに読み込んだ本文と、レスポンスのステータス・ヘッダー"""
+
+    def __init__(self, response, content, truncated):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = response.url
+        self.content = content
+        # 上限に達したため本文の途中で読み込みを打ち切ったかどうか
+        self.truncated = truncated
+        self._response = response
+
+    @property
+    def text(self):
+        """本文を文字列にする（ヘッダー、metaタグのcharset、UTF-8の順に文字コードを決める）"""
+        from requests.utils import get_encoding_from_headers
+
+        encoding = None
+        if "charset" in self.headers.get("content-type", "").lower():
+            encoding = get_encoding_from_headers(self.headers)
+        if encoding is None:
+            declared = META_CHARSET_PATTERN.search(self.content[:4096])
+            encoding = declared.group(1).decode("ascii") if declared else "utf-8"
+        try:
+            return self.content.decode(encoding, errors="replace")
+        except LookupError:
+            return self.content.decode("utf-8", errors="replace")
+
+    def raise_for_status(self):
+        self._response.raise_for_status()
+
+
+class HTTPClient:
+    """ホストごとの接続を使い回す共有HTTPクライアント
+
+    keep-aliveの接続プール、接続・読み込みのタイムアウト、gzip（brotliがあればbrも）の
+    圧縮転送、リダイレクト回数の上限を設定し、本文は上限のバイト数までストリーミングで読み込む。
+    """
+
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None, max_redirects=None,
+                 max_bytes=None):
+        # requestsは最初のクライアントを作るまで読み込まない
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.connect_timeout = connect_timeout or float(os.getenv("CVR_HTTP_CONNECT_TIMEOUT", "5"))
+        self.read_timeout = read_timeout or float(os.getenv("CVR_HTTP_READ_TIMEOUT", "20"))
+        self.max_bytes = max_bytes or int(os.getenv("CVR_HTTP_MAX_BYTES", str(10 * 1024 * 1024)))
+        pool_size = pool_size or int(os.getenv("CVR_HTTP_POOL_SIZE", "10"))
+
+        session = requests.Session()
+        session.max_redirects = max_redirects or int(os.getenv("CVR_HTTP_MAX_REDIRECTS", "5"))
+        session.headers.update({"User-Agent": DEFAULT_USER_AGENT, "Accept-Encoding": ACCEPT_ENCODING})
+        # 接続の確立に失敗した場合だけ短い間隔で再試行する（送信済みのリクエストは再送しない）
+        retry = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.3)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        self.session = session
+
+    def get(self, url, headers=None, max_bytes=None, allow_truncated=True):
+        """URLを取得する
+
+        本文が max_bytes（省略時は CVR_HTTP_MAX_BYTES）を超えた時点で読み込みをやめる。
+        allow_truncated=False の場合は ResponseTooLarge を送出する。
+        """
+        max_bytes = max_bytes or self.max_bytes
+        with self.session.get(url, headers=headers, stream=True,
+                              timeout=(self.connect_timeout, self.read_timeout)) as response:
+            declared = response.headers.get("content-length")
+            if not allow_truncated and declared and declared.isdigit() and int(declared) > max_bytes:
+                raise ResponseTooLarge(f"レスポンスが上限（{max_bytes}バイト）を超えています: {url}")
+
+            chunks = []
+            size = 0
+            truncated = False
+            for chunk in response.iter_content(_CHUNK_SIZE):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > max_bytes:
+                    truncated = True
+                    break
+
+            if truncated:
+                if not allow_truncated:
+                    raise ResponseTooLarge(f"レスポンスが上限（{max_bytes}バイト）を超えています: {url}")
+                print(f"レスポンスが上限（{max_bytes}バイト）を超えたため、途中までを使用します: {url}")
+            return HTTPResponse(response, b"".join(chunks)[:max_bytes], truncated)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_http_client():
+    """プロセス共有のHTTPクライアントを返す"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HTTPClient()
+        return _client
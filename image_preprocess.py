@@ -0,0 +1,67 @@
+import io
+import os
+import base64
+from screenshot_store import screenshot_file_path
+import tracing
+
+# base64は3バイト単位で区切れるため、チャンクサイズは3の倍数にする
+_BASE64_CHUNK_SIZE = 3 * 64 * 1024
+
+
+def prepare_screenshot(screenshot_path, max_width=None, tile_height=None, max_tiles=None,
+                       image_format=None, quality=None):
+    """ビジョンモデルに送るためにスクリーンショットを縮小・分割・再エンコードする
+
+    モデルの実効解像度を超える幅は縮小し、縦に長いページはビューポート程度の高さの
+    タイルに分割して先頭から max_tiles 枚だけを残す。戻り値はdata URLのリスト（上から順）。
+    """
+    max_width = max_width or int(os.getenv("CVR_VISION_MAX_WIDTH", "1024"))
+    tile_height = tile_height or int(os.getenv("CVR_VISION_TILE_HEIGHT", "1024"))
+    max_tiles = max_tiles or int(os.getenv("CVR_VISION_MAX_TILES", "3"))
+    image_format = (image_format or os.getenv("CVR_VISION_IMAGE_FORMAT", "JPEG")).upper()
+    quality = quality or int(os.getenv("CVR_VISION_IMAGE_QUALITY", "80"))
+
+    # Pillowは最初に画像を扱うときまで読み込まない
+    from PIL import Image
+
+    with Image.open(screenshot_file_path(screenshot_path)) as image:
+        width, height = image.size
+        scale = min(1.0, max_width / width)
+        # 縮小後の座標でのタイルの高さを、元画像の座標に換算する
+        source_tile_height = max(1, int(tile_height / scale))
+
+        data_urls = []
+        for top in range(0, height, source_tile_height):
+            if len(data_urls) >= max_tiles:
+                break
+            bottom = min(height, top + source_tile_height)
+            tile = image.crop((0, top, width, bottom))
+            if scale < 1.0:
+                tile = tile.resize((max(1, round(width * scale)), max(1, round((bottom - top) * scale))),
+                                   Image.LANCZOS)
+            data_urls.append(encode_data_url(tile, image_format, quality))
+        return data_urls
+
+
+def encode_data_url(image, image_format="JPEG", quality=80):
+    """画像をJPEG/WebPにエンコードし、チャンク単位でbase64化したdata URLを返す"""
+    if image.mode not in ("RGB", "L"):
+        # JPEGはアルファチャンネルを扱えない
+        image = image.convert("RGB")
+
+    buffer = io.BytesIO()
+    with tracing.span("image_encode", format=image_format, width=image.width, height=image.height):
+        image.save(buffer, format=image_format, quality=quality, optimize=True)
+
+    # エンコード済みバイト列をコピーせず、区切りながらbase64化する
+    view = buffer.getbuffer()
+    try:
+        with tracing.span("base64_encode", bytes=len(view)):
+            chunks = [
+                base64.b64encode(view[start:start + _BASE64_CHUNK_SIZE]).decode("ascii")
+                for start in range(0, len(view), _BASE64_CHUNK_SIZE)
+            ]
+    finally:
+        view.release()
+
+    return f"data:image/{image_format.lower()};base64,{''.join(chunks)}"
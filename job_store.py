@@ -0,0 +1,109 @@
+import os
+import json
+import sqlite3
+import threading
+
+DEFAULT_JOB_PATH = os.path.join(os.path.dirname(__file__), "data", "jobs.sqlite3")
+
+
+class JobStore:
+    """分析ジョブの状態と途中経過のイベントを保存するストア
+
+    マルチプロセスのWebサーバーでは、ジョブを受け付けたワーカープロセスとは別のプロセスに
+    状態の問い合わせやイベントの購読が届く。すべてのプロセスが同じSQLiteファイルを参照することで、
+    どのプロセスからでもジョブを参照できるようにする。
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv("CVR_JOB_STORE_PATH", DEFAULT_JOB_PATH)
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def save(self, job):
+        """ジョブの状態（イベント以外）を保存する"""
+        result_json = json.dumps(job.result, ensure_ascii=False) if job.result is not None else None
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs "
+                "(id, url, status, error, result_json, created_at, started_at, finished_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.id, job.url, job.status, job.error, result_json,
+                 job.created_at, job.started_at, job.finished_at)
+            )
+            conn.commit()
+
+    def add_event(self, job_id, event):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO job_events (job_id, id, event, data_json) VALUES (?, ?, ?, ?)",
+                (job_id, event["id"], event["event"], json.dumps(event["data"], ensure_ascii=False))
+            )
+            conn.commit()
+
+    def get(self, job_id):
+        """ジョブの状態を返す。なければNone"""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT id, url, status, error, result_json, created_at, started_at, finished_at "
+                "FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "url": row[1],
+            "status": row[2],
+            "error": row[3],
+            "result": json.loads(row[4]) if row[4] is not None else None,
+            "created_at": row[5],
+            "started_at": row[6],
+            "finished_at": row[7]
+        }
+
+    def events(self, job_id, after=0):
+        """id が after より大きいイベントを古い順に返す"""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT id, event, data_json FROM job_events WHERE job_id = ? AND id > ? ORDER BY id",
+                (job_id, after)
+            ).fetchall()
+        return [{"id": event_id, "event": event, "data": json.loads(data_json)} for event_id, event, data_json in rows]
+
+    def delete(self, job_id):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM job_events WHERE job_id = ?", (job_id,))
+                conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def prune(self, finished_before):
+        """finished_before（UNIX時刻）より前に完了したジョブとそのイベントを削除する"""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "DELETE FROM job_events WHERE job_id IN "
+                    "(SELECT id FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?)", (finished_before,)
+                )
+                conn.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (finished_before,))
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, url TEXT, status TEXT, error TEXT, result_json TEXT, "
+                "created_at REAL, started_at REAL, finished_at REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_events ("
+                "job_id TEXT, id INTEGER, event TEXT, data_json TEXT, PRIMARY KEY (job_id, id))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_finished_at ON jobs (finished_at)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
@@ -0,0 +1,226 @@
+import os
+import time
+import uuid
+import queue
+import threading
+import traceback
+from job_store import JobStore
+
+
+class QueueFullError(Exception):
+    """ジョブキューが満杯で新しいジョブを受け付けられない"""
+
+
+class Job:
+    """バックグラウンドで実行される1件の分析ジョブ"""
+
+    def __init__(self, url, options=None, store=None):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        # 分析関数にキーワード引数として渡すオプション（render_mode など）
+        self.options = options or {}
+        self.status = "queued"  # queued / running / done / failed
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # 分析の途中経過（ステージごとの出力）。idは1から始まる連番
+        self.events = []
+        self._events_changed = threading.Condition()
+        # 他のプロセスからも参照できるよう、状態とイベントを書き込むストア
+        self._store = store
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def add_event(self, name, data):
+        """途中経過のイベントを追加し、待機中の購読者に知らせる"""
+        with self._events_changed:
+            event = {"id": len(self.events) + 1, "event": name, "data": data}
+            self.events.append(event)
+            if self._store is not None:
+                try:
+                    self._store.add_event(self.id, event)
+                except Exception as e:
+                    # ストアへの書き込みに失敗しても、このプロセスの購読者には届ける
+                    print(f"ジョブのイベントの保存エラー ({self.id}): {str(e)}")
+            self._events_changed.notify_all()
+
+    def start(self):
+        """ジョブを実行中にする"""
+        self.status = "running"
+        self.started_at = time.time()
+        self._save()
+        self.add_event("started", {"url": self.url})
+
+    def wait_events(self, after=0, timeout=15.0):
+        """id が after より大きいイベントを返す。まだなければ追加されるか timeout 秒経つまで待つ"""
+        with self._events_changed:
+            self._events_changed.wait_for(lambda: len(self.events) > after, timeout)
+            return self.events[after:]
+
+    def finish(self, result=None, error=None):
+        """ジョブを完了させる。状態の更新と最後のイベント（done / failed）の追加は同時に行う"""
+        with self._events_changed:
+            self.result = result
+            self.error = error
+            self.status = "failed" if error is not None else "done"
+            self.finished_at = time.time()
+            self._save()
+            if error is not None:
+                self.add_event("failed", {"error": error})
+            else:
+                self.add_event("done", {"result_id": result.get("id") if isinstance(result, dict) else None})
+
+    def _save(self):
+        if self._store is None:
+            return
+        try:
+            self._store.save(self)
+        except Exception as e:
+            print(f"ジョブの状態の保存エラー ({self.id}): {str(e)}")
+
+    def to_dict(self, include_result=False):
+        data = {
+            "id": self.id,
+            "url": self.url,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+        if self.status == "done" and isinstance(self.result, dict):
+            # 保存済みの結果はIDで再取得できる
+            data["result_id"] = self.result.get("id")
+        if include_result and self.status == "done":
+            data["result"] = self.result
+        return data
+
+
+class StoredJob(Job):
+    """他のプロセスが実行しているジョブ。状態とイベントはジョブストアから読む"""
+
+    # イベントが追加されたかをストアに問い合わせる間隔（秒）
+    poll_interval = 0.5
+
+    def __init__(self, store, state):
+        super().__init__(state["url"], store=store)
+        self.id = state["id"]
+        self._apply(state)
+
+    def wait_events(self, after=0, timeout=15.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self._store.events(self.id, after)
+            if events or time.monotonic() >= deadline:
+                break
+            time.sleep(min(self.poll_interval, max(0.0, deadline - time.monotonic())))
+        # 完了したかどうかを呼び出し元が判断できるよう、状態も読み直す
+        state = self._store.get(self.id)
+        if state is not None:
+            self._apply(state)
+        return events
+
+    def _apply(self, state):
+        for key in ("status", "error", "result", "created_at", "started_at", "finished_at"):
+            setattr(self, key, state[key])
+
+
+class JobManager:
+    """固定数のワーカースレッドで分析ジョブを実行する
+
+    キューが満杯のときは QueueFullError を送出し、Webリクエストを待たせない。
+    完了したジョブは retention 秒経過後に破棄する。
+    ジョブは受け付けたプロセスのワーカーが実行し、状態とイベントはジョブストア（SQLite）に書き込むので、
+    マルチプロセスのWebサーバーでもどのプロセスからでも参照できる。
+    """
+
+    def __init__(self, run_func, workers=None, queue_size=None, retention=None, store=None):
+        self.run_func = run_func
+        self.workers = workers or int(os.getenv("CVR_JOB_WORKERS", "2"))
+        self.queue_size = queue_size or int(os.getenv("CVR_JOB_QUEUE_SIZE", "20"))
+        self.retention = retention or float(os.getenv("CVR_JOB_RETENTION", "3600"))
+
+        self.store = store or JobStore()
+
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def submit(self, url, **options):
+        """ジョブを登録してすぐに返す"""
+        self._start_workers()
+        self._prune()
+
+        job = Job(url, options, store=self.store)
+        with self._lock:
+            self._jobs[job.id] = job
+        # ワーカーが実行中に更新した状態を上書きしないよう、キューに入れる前に保存する
+        job._save()
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+            self.store.delete(job.id)
+            raise QueueFullError(f"分析待ちのジョブが上限（{self.queue_size}件）に達しています")
+        return job
+
+    def get(self, job_id):
+        """ジョブを返す。このプロセスのジョブでなければジョブストアから読む。なければNone"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        state = self.store.get(job_id)
+        return StoredJob(self.store, state) if state is not None else None
+
+    def stats(self):
+        """キューの深さとワーカーの状況を返す（このプロセスの分）"""
+        with self._lock:
+            running = sum(1 for job in self._jobs.values() if job.status == "running")
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queued": self._queue.qsize(),
+            "running": running
+        }
+
+    def _start_workers(self):
+        # プリフォーク型サーバーでもワーカープロセスごとにスレッドを持てるよう、初回投入時に起動する
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"cvr-job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            job.start()
+            try:
+                job.finish(result=self.run_func(job.url, on_event=job.add_event, **job.options))
+            except Exception as e:
+                print(f"ジョブ実行エラー ({job.id}): {str(e)}")
+                traceback.print_exc()
+                job.finish(error=str(e))
+            finally:
+                self._queue.task_done()
+
+    def _prune(self):
+        """保持期間を過ぎた完了済みジョブを破棄する"""
+        now = time.time()
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job.finished and now - job.finished_at > self.retention
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+        self.store.prune(now - self.retention)
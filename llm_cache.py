@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import namedtuple
+
+# キャッシュキー: key は model・プロンプト・画像・パラメータ全体のハッシュ
+CacheKey = namedtuple("CacheKey", ["key", "model", "prompt_hash", "image_digest"])
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(__file__), "data", "llm_cache.sqlite3")
+
+
+class LLMResponseCache:
+    """OpenAI応答をディスク（SQLite）に保存するコンテンツアドレス型キャッシュ
+
+    キーはモデル名・テキストプロンプトのハッシュ・画像のダイジェストから作る。
+    有効期限（TTL）とエントリ数上限によるLRU削除に対応する。
+    """
+
+    def __init__(self, path=None, ttl=None, max_entries=None, enabled=None):
+        if enabled is None:
+            enabled = os.getenv("CVR_LLM_CACHE", "1") != "0"
+        self.enabled = enabled
+        self.path = path or os.getenv("CVR_LLM_CACHE_PATH", DEFAULT_CACHE_PATH)
+        # 秒単位。0以下なら期限なし
+        self.ttl = ttl if ttl is not None else float(os.getenv("CVR_LLM_CACHE_TTL", str(7 * 24 * 3600)))
+        self.max_entries = max_entries or int(os.getenv("CVR_LLM_CACHE_MAX_ENTRIES", "5000"))
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def make_key(self, model, messages, params=None):
+        """リクエスト内容からキャッシュキーを作る"""
+        texts = []
+        image_digests = []
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, str):
+                texts.append(f"{message['role']}:{content}")
+                continue
+            for part in content:
+                if part.get("type") == "image_url":
+                    image_url = part["image_url"]["url"].encode("utf-8")
+                    image_digests.append(hashlib.sha256(image_url).hexdigest())
+                else:
+                    texts.append(f"{message['role']}:{part.get('text', '')}")
+
+        prompt_hash = hashlib.sha256("\n".join(texts).encode("utf-8")).hexdigest()
+        image_digest = hashlib.sha256(",".join(image_digests).encode("utf-8")).hexdigest() if image_digests else ""
+        params_json = json.dumps(params or {}, sort_keys=True, ensure_ascii=False)
+        key = hashlib.sha256(f"{model}|{prompt_hash}|{image_digest}|{params_json}".encode("utf-8")).hexdigest()
+        return CacheKey(key, model, prompt_hash, image_digest)
+
+    def get(self, cache_key):
+        """キャッシュ済みの応答を返す。なければNone"""
+        if not self.enabled:
+            return None
+
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT content, created_at FROM responses WHERE key = ?", (cache_key.key,)
+            ).fetchone()
+            if row and self.ttl > 0 and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (cache_key.key,))
+                conn.commit()
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, cache_key.key))
+            conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, cache_key, content):
+        """応答を保存し、上限を超えた分を最終アクセスが古い順に削除する"""
+        if not self.enabled:
+            return
+
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, prompt_hash, image_digest, content, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (cache_key.key, cache_key.model, cache_key.prompt_hash, cache_key.image_digest, content, now, now)
+            )
+            count = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                excess = count - self.max_entries
+                conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)", (excess,)
+                )
+                self.evictions += excess
+            conn.commit()
+
+    def clear(self):
+        """キャッシュをすべて削除する"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM responses")
+            conn.commit()
+
+    def stats(self):
+        """ヒット・ミス数などの統計を返す"""
+        entries = 0
+        if self.enabled:
+            with self._lock:
+                entries = self._connect().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0,
+            "evictions": self.evictions,
+            "entries": entries
+        }
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, prompt_hash TEXT, image_digest TEXT, "
+                "content TEXT, created_at REAL, last_access REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
@@ -0,0 +1,241 @@
+import os
+import time
+import random
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
+from metrics import LLM_CALLS, LLM_CIRCUIT_STATE, LLM_TOKENS
+import tracing
+
+
+class CircuitOpenError(Exception):
+    """障害が続いているため、APIを呼ばずにすぐ失敗させた"""
+
+
+class LLMDeadlineExceeded(TimeoutError):
+    """1回の呼び出しに許された時間（リトライを含む）を使い切った"""
+
+
+# cvr_llm_circuit_state に出力する値
+CIRCUIT_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+@lru_cache(maxsize=None)
+def retryable_errors():
+    """一時的な障害とみなしてリトライするエラー（openaiの読み込みを最初の呼び出しまで遅らせる）"""
+    import openai
+    return (
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.RateLimitError,
+        openai.InternalServerError,
+        TimeoutError
+    )
+
+
+class CircuitBreaker:
+    """連続した失敗が閾値に達したら一定時間呼び出しを遮断する
+
+    遮断時間が過ぎると1件だけ試行を通し（half-open）、成功すれば元に戻す。
+    """
+
+    def __init__(self, failure_threshold=None, reset_timeout=None):
+        self.failure_threshold = failure_threshold or int(os.getenv("CVR_LLM_BREAKER_THRESHOLD", "5"))
+        self.reset_timeout = reset_timeout or float(os.getenv("CVR_LLM_BREAKER_RESET", "30"))
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    print(f"LLM呼び出しの失敗が{self._failures}回続いたため、{self.reset_timeout}秒間遮断します")
+                self._opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """直近の応答時間を保持し、パーセンタイルを返す"""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p, min_samples=20):
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+class ResilientLLMClient:
+    """OpenAI Chat Completions の呼び出しに、期限・リトライ・遮断・ヘッジを加える
+
+    - 1回の呼び出し（リトライを含む）は timeout 秒以内に終える
+    - 一時的なエラーは指数バックオフ（ジッター付き）で max_retries 回までリトライする
+    - 一時的なエラーが続いたら CircuitBreaker が遮断し、CircuitOpenError ですぐ失敗させる
+    - hedge_percentile を指定すると、応答がそのパーセンタイルの時間を超えた時点で
+      同じリクエストをもう1件送り、先に返ってきた方を使う
+    """
+
+    def __init__(self, client=None, timeout=None, max_retries=None, backoff_base=None, backoff_max=None,
+                 hedge_percentile=None, breaker=None):
+        # OpenAIクライアントは最初の呼び出しまで作らない（client を渡した場合はそれを使う）
+        self._client = client
+        self._client_lock = threading.Lock()
+        self.timeout = timeout or float(os.getenv("CVR_LLM_TIMEOUT", "90"))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("CVR_LLM_MAX_RETRIES", "3"))
+        self.backoff_base = backoff_base or float(os.getenv("CVR_LLM_BACKOFF_BASE", "1.0"))
+        self.backoff_max = backoff_max or float(os.getenv("CVR_LLM_BACKOFF_MAX", "20"))
+        # 0ならヘッジしない
+        self.hedge_percentile = (hedge_percentile if hedge_percentile is not None
+                                 else float(os.getenv("CVR_LLM_HEDGE_PERCENTILE", "0")))
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = {}
+        self._latency_lock = threading.Lock()
+        self._hedge_executor = None
+        LLM_CIRCUIT_STATE.set_function(lambda: CIRCUIT_STATE_VALUES[self.breaker.state])
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                import openai
+                # リトライはこの層で行うので、SDK側のリトライは無効にする
+                self._client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+            return self._client
+
+    def create(self, **request):
+        """chat.completions.create を呼び出して応答を返す。失敗した場合は最後のエラーを送出する"""
+        model = request.get("model")
+        if not self.breaker.allow():
+            LLM_CALLS.labels(model=model, outcome="circuit_open").inc()
+            raise CircuitOpenError("LLM APIの障害が続いているため呼び出しを遮断中です")
+
+        deadline = time.monotonic() + self.timeout
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.breaker.record_failure()
+                LLM_CALLS.labels(model=model, outcome="error").inc()
+                raise LLMDeadlineExceeded(f"LLM呼び出しが{self.timeout}秒以内に完了しませんでした")
+            try:
+                response = self._attempt(request, remaining)
+            except retryable_errors() as e:
+                if attempt >= self.max_retries:
+                    self.breaker.record_failure()
+                    LLM_CALLS.labels(model=model, outcome="error").inc()
+                    raise
+                delay = min(self._backoff(attempt, e), max(0.0, deadline - time.monotonic()))
+                print(f"LLM呼び出しを{delay:.1f}秒後にリトライします（{attempt + 1}回目）: {type(e).__name__}")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except Exception:
+                # リクエスト内容のエラー（400など）はAPI自体は応答しているので、遮断の判定には数えない
+                self.breaker.record_success()
+                LLM_CALLS.labels(model=model, outcome="error").inc()
+                raise
+            self.breaker.record_success()
+            self._record_usage(model, response)
+            return response
+
+    def _record_usage(self, model, response):
+        LLM_CALLS.labels(model=model, outcome="success").inc()
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            LLM_TOKENS.labels(model=model, type="prompt").inc(usage.prompt_tokens or 0)
+            LLM_TOKENS.labels(model=model, type="completion").inc(usage.completion_tokens or 0)
+
+    def _backoff(self, attempt, error):
+        """次のリトライまでの待ち時間（Retry-After があればそれを優先する）"""
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return min(self.backoff_max, float(retry_after))
+            except ValueError:
+                pass
+        # フルジッター: 0〜上限の一様乱数
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _attempt(self, request, timeout):
+        hedge_delay = None
+        if self.hedge_percentile:
+            hedge_delay = self._tracker(request.get("model")).percentile(self.hedge_percentile)
+        if hedge_delay is None or hedge_delay >= timeout:
+            return self._call(request, timeout)
+
+        executor = self._executor()
+        started = time.monotonic()
+        call = tracing.wrap(self._call)
+        futures = {executor.submit(call, request, timeout)}
+        done, _ = wait(futures, timeout=hedge_delay)
+        if not done:
+            print(f"LLM応答が{hedge_delay:.1f}秒を超えたため、ヘッジリクエストを送ります")
+            futures.add(executor.submit(call, request, max(0.1, timeout - (time.monotonic() - started))))
+
+        # 先に成功した応答を使う。両方失敗したら最後のエラーを送出する
+        error = None
+        while futures:
+            done, futures = wait(futures, timeout=max(0.0, timeout - (time.monotonic() - started)),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                raise LLMDeadlineExceeded("LLM呼び出しが期限内に完了しませんでした")
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _call(self, request, timeout):
+        started = time.monotonic()
+        with tracing.span("openai", model=request.get("model")):
+            response = self.client.chat.completions.create(timeout=timeout, **request)
+        self._tracker(request.get("model")).record(time.monotonic() - started)
+        return response
+
+    def _tracker(self, model):
+        with self._latency_lock:
+            if model not in self.latency:
+                self.latency[model] = LatencyTracker()
+            return self.latency[model]
+
+    def _executor(self):
+        with self._latency_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="llm-hedge")
+            return self._hedge_executor
@@ -0,0 +1,262 @@
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+# Prometheusのテキスト形式（version 0.0.4）
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# ステージ（LLM呼び出し・ページ読み込み）は秒〜分、ルールはミリ秒単位で分布する
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+RULE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+class _Metric:
+    """ラベルの値ごとの子を持つメトリクスの共通部分"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, **labels):
+        """ラベルの値を指定した子を返す"""
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} のラベルは {', '.join(self.labelnames)} です")
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            if key not in self._children:
+                self._children[key] = self._new_child()
+            return self._children[key]
+
+    def _unlabeled(self):
+        if self.labelnames:
+            raise ValueError(f"{self.name} にはラベルの指定が必要です")
+        return self._children[()]
+
+    def _samples(self):
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in children:
+            for suffix, extra, value in child.samples():
+                yield self.name + suffix, dict(zip(self.labelnames, key), **extra), value
+
+    def _new_child(self):
+        raise NotImplementedError
+
+
+class _Value:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0.0
+        self._function = None
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self._value = float(value)
+
+    def set_function(self, function):
+        """出力のたびに function() の戻り値を値とする"""
+        self._function = function
+
+    @contextmanager
+    def track_inprogress(self):
+        """ブロックを実行している間だけ1増やす"""
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+    def samples(self):
+        if self._function is not None:
+            try:
+                value = float(self._function())
+            except Exception:
+                value = math.nan
+            return [("", {}, value)]
+        with self._lock:
+            return [("", {}, self._value)]
+
+
+class Counter(_Metric):
+    """増加するだけのカウンター（名前は _total で終える）"""
+
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self._unlabeled().inc(amount)
+
+    def _new_child(self):
+        return _CounterValue()
+
+
+class _CounterValue(_Value):
+    def inc(self, amount=1):
+        if amount < 0:
+            raise ValueError("カウンターは減らせません")
+        super().inc(amount)
+
+
+class Gauge(_Metric):
+    """増減する現在値"""
+
+    kind = "gauge"
+
+    def inc(self, amount=1):
+        self._unlabeled().inc(amount)
+
+    def dec(self, amount=1):
+        self._unlabeled().dec(amount)
+
+    def set(self, value):
+        self._unlabeled().set(value)
+
+    def set_function(self, function):
+        self._unlabeled().set_function(function)
+
+    def track_inprogress(self):
+        return self._unlabeled().track_inprogress()
+
+    def _new_child(self):
+        return _Value()
+
+
+class Histogram(_Metric):
+    """観測値の分布（累積バケット・合計・件数）"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value):
+        self._unlabeled().observe(value)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._sum = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self._sum += value
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        """ブロックの実行時間（秒）を観測する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self._buckets, counts):
+            cumulative += count
+            samples.append(("_bucket", {"le": _format_value(bound)}, cumulative))
+        samples.append(("_sum", {}, total))
+        samples.append(("_count", {}, cumulative))
+        return samples
+
+
+class Registry:
+    """メトリクスの一覧。render() でPrometheusのテキスト形式にする"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"メトリクスが重複しています: {metric.name}")
+            self._metrics[metric.name] = metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation, help_text=True)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric._samples():
+                label_text = ",".join(f'{key}="{_escape(str(val))}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {_format_value(value)}" if label_text
+                             else f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(text, help_text=False):
+    text = text.replace("\\", "\\\\").replace("\n", "\\n")
+    return text if help_text else text.replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+REGISTRY = Registry()
+
+
+def render():
+    """既定のレジストリの内容をPrometheusのテキスト形式で返す"""
+    return REGISTRY.render()
+
+
+# アプリケーションのメトリクス
+STAGE_DURATION = Histogram(
+    "cvr_stage_duration_seconds", "analyze_website の各ステージの実行時間", ["stage"])
+RULE_DURATION = Histogram(
+    "cvr_rule_duration_seconds", "ルールチェックの各ルールの実行時間", ["rule"], buckets=RULE_BUCKETS)
+LLM_CALLS = Counter(
+    "cvr_llm_calls_total", "LLM API呼び出しの回数（outcome: success / error / circuit_open / cache_hit）",
+    ["model", "outcome"])
+LLM_TOKENS = Counter(
+    "cvr_llm_tokens_total", "LLM APIで消費したトークン数（type: prompt / completion）", ["model", "type"])
+FALLBACK_RESULTS = Counter(
+    "cvr_fallback_results_total", "APIの応答の代わりにデフォルト値を使ったステージの出力の数", ["stage"])
+JSON_PARSE_FAILURES = Counter(
+    "cvr_json_parse_failures_total", "LLMの応答をJSONとして解析できなかった回数", ["stage"])
+ANALYSES_IN_FLIGHT = Gauge(
+    "cvr_analyses_in_flight", "実行中の analyze_website の数")
+BROWSER_SESSIONS_OPEN = Gauge(
+    "cvr_browser_sessions_open", "起動済み（貸し出し中を含む）のブラウザセッション数")
+LLM_CIRCUIT_STATE = Gauge(
+    "cvr_llm_circuit_state", "LLM呼び出しの遮断状態（0: closed / 1: half_open / 2: open）")
@@ -0,0 +1,282 @@
+import os
+import json
+import base64
+import time
+import threading
+from browser_pool import DEVICE_PROFILES, get_browser_pool
+from document_index import DocumentIndex
+from http_client import get_http_client
+from screenshot_store import get_screenshot_store
+import tracing
+
+# CTA候補・フォーム項目・テキストブロックの状態を1回のスクリプト実行でまとめて取得する。
+# 座標はドキュメント基準（スクロール量を加算済み）のCSSピクセル。
+DOM_SNAPSHOT_SCRIPT = """
+const isCta = (el) => {
+    const cls = (typeof el.className === 'string' ? el.className : (el.getAttribute('class') || '')).toLowerCase();
+    return cls.includes('btn') || cls.includes('button') || cls.includes('cta');
+};
+const TEXT_BLOCK_SELECTOR = 'h1, h2, h3, h4, h5, h6, p, li, label';
+const MAX_TEXT_BLOCKS = 500;
+const isTransparent = (color) => !color || color === 'transparent' || /rgba\\([^)]*,\\s*0\\)$/.test(color);
+const effectiveBackground = (el) => {
+    // 背景が透明な場合は、色が付いている祖先要素までさかのぼる
+    for (let node = el; node && node.nodeType === 1; node = node.parentElement) {
+        const color = window.getComputedStyle(node).backgroundColor;
+        if (!isTransparent(color)) {
+            return color;
+        }
+    }
+    return 'rgb(255, 255, 255)';
+};
+const describe = (el) => {
+    const style = window.getComputedStyle(el);
+    const rect = el.getBoundingClientRect();
+    return {
+        tag: el.tagName.toLowerCase(),
+        text: (el.innerText || el.value || el.getAttribute('aria-label') || '').trim().slice(0, 200),
+        bbox: {
+            x: rect.left + window.scrollX,
+            y: rect.top + window.scrollY,
+            width: rect.width,
+            height: rect.height
+        },
+        color: style.color,
+        background_color: style.backgroundColor,
+        effective_background_color: effectiveBackground(el),
+        visible: style.display !== 'none' && style.visibility !== 'hidden' &&
+            parseFloat(style.opacity) > 0 && rect.width > 0 && rect.height > 0
+    };
+};
+
+const forms = Array.from(document.forms);
+const snapshot = {
+    viewport: {
+        width: window.innerWidth,
+        height: window.innerHeight,
+        scroll_height: document.body ? document.body.scrollHeight : 0,
+        device_pixel_ratio: window.devicePixelRatio
+    },
+    ctas: Array.from(document.querySelectorAll('a, button')).filter(isCta).map((el) => {
+        const entry = describe(el);
+        entry.href = el.getAttribute('href');
+        return entry;
+    }),
+    fields: Array.from(document.querySelectorAll('input, textarea, select')).map((el) => {
+        const entry = describe(el);
+        entry.type = (el.getAttribute('type') || '').toLowerCase();
+        entry.name = el.getAttribute('name');
+        entry.required = el.required;
+        entry.form_index = el.form ? forms.indexOf(el.form) : -1;
+        return entry;
+    }),
+    // コントラスト測定用のテキストブロック（多すぎるページでは先頭から上限まで）
+    texts: Array.from(document.querySelectorAll(TEXT_BLOCK_SELECTOR))
+        .filter((el) => !isCta(el) && (el.innerText || '').trim())
+        .slice(0, MAX_TEXT_BLOCKS)
+        .map(describe)
+};
+return JSON.stringify(snapshot);
+"""
+
+
+class FetchResult:
+    """HTTPで取得したページと、条件付きリクエスト用の検証子"""
+
+    def __init__(self, html, status, etag=None, last_modified=None):
+        self.html = html
+        self.status = status
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def not_modified(self):
+        return self.status == 304
+
+
+class PageArtifacts:
+    """1回のページ読み込みから得られる成果物一式
+
+    テキスト分析・視覚分析・ルールチェックがすべて同じ読み込み結果を参照することで、
+    動的なページでも各分析が同じバージョンのページを評価する。
+    """
+
+    def __init__(self, url):
+        self.url = url
+        # HTTPで取得した生のHTML（JavaScript実行前）と、その取得結果（検証子など）
+        self.raw_html = None
+        self.fetch = None
+        # ブラウザでレンダリングした後のDOM
+        self.rendered_html = None
+        # デスクトップ表示のビューポートの高さ（px）
+        self.viewport_height = None
+        # DOM_SNAPSHOT_SCRIPT で取得したCTA・フォーム項目・テキストブロックのスナップショット
+        self.dom_snapshot = None
+        # デバイスタイプ -> スクリーンショットのファイルパス
+        self.screenshots = {}
+        # keep_driver=True で読み込んだ場合のみ、ページを開いたままのドライバー
+        self.driver = None
+        self._session = None
+        self._document = None
+        self._document_lock = threading.Lock()
+
+    @property
+    def document(self):
+        """レンダリング後のDOM（なければ生のHTML）を解析した DocumentIndex
+
+        テキスト分析とルールチェックが並行して参照しても、解析は1回だけ行う。
+        """
+        with self._document_lock:
+            if self._document is None:
+                self._document = DocumentIndex(self.rendered_html or self.raw_html)
+            return self._document
+
+    def release(self):
+        """保持しているブラウザセッションをプールへ返す"""
+        if self._session is not None:
+            session, self._session = self._session, None
+            self.driver = None
+            get_browser_pool().checkin(session)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+
+def fetch_html(url, etag=None, last_modified=None):
+    """ウェブサイトのHTMLをHTTPで取得し、ETag・Last-Modifiedとともに返す
+
+    etag / last_modified を渡すと条件付きリクエストを送り、
+    変更がなければ not_modified=True（html は None）の結果を返す。
+    """
+    # User-Agent・Accept-Encoding は共有クライアントのセッションに設定済み
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    try:
+        with tracing.span("fetch", url=url):
+            response = get_http_client().get(url, headers=headers)
+        if response.status_code == 304:
+            return FetchResult(None, 304, etag, last_modified)
+        response.raise_for_status()
+        return FetchResult(response.text, response.status_code,
+                           response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    except Exception as e:
+        print(f"コンテンツ取得エラー: {str(e)}")
+        return FetchResult("<html><body>コンテンツを取得できませんでした</body></html>", None, None, None)
+
+
+def static_page(url, fetch):
+    """ブラウザを使わず、HTTPで取得したHTMLだけから成果物を作る（テキストのみの高速モード用）"""
+    artifacts = PageArtifacts(url)
+    artifacts.fetch = fetch
+    artifacts.raw_html = fetch.html
+    return artifacts
+
+
+def render_page(url, devices=("desktop", "mobile"), keep_driver=False):
+    """URLをブラウザで1回だけ読み込み、DOMと各デバイスのスクリーンショットを取得する
+
+    モバイル表示はページを再読み込みせず、同じドキュメントに対して
+    ビューポートとUAのエミュレーションを切り替えて撮影する。
+    keep_driver=True の場合はページを開いたままのドライバーを保持するので、
+    利用後に release() を呼ぶこと。
+    """
+    pool = get_browser_pool()
+    with tracing.span("browser_checkout"):
+        session = pool.checkout("desktop")
+    driver = session.driver
+    artifacts = PageArtifacts(url)
+
+    try:
+        with tracing.span("navigate", url=url):
+            driver.get(url)
+        # 読み込み後のJavaScriptによる描画を待つ
+        with tracing.span("settle"):
+            time.sleep(float(os.getenv("CVR_PAGE_SETTLE_SECONDS", "2")))
+        # 返却時にストレージを消せるよう、リダイレクト先やiframeのオリジンも記録しておく
+        session.record_visit(url)
+
+        with tracing.span("dom_snapshot"):
+            artifacts.rendered_html = driver.page_source
+            artifacts.dom_snapshot = collect_dom_snapshot(driver)
+        artifacts.viewport_height = artifacts.dom_snapshot["viewport"]["height"]
+
+        for device_type in devices:
+            with tracing.span("screenshot", device=device_type):
+                png = _capture_full_page(driver, device_type, session.default_user_agent)
+            with tracing.span("save_screenshot", device=device_type, bytes=len(png)):
+                artifacts.screenshots[device_type] = save_screenshot(url, device_type, png)
+    except Exception:
+        pool.checkin(session, discard=True)
+        raise
+
+    if keep_driver:
+        artifacts.driver = driver
+        artifacts._session = session
+    else:
+        pool.checkin(session)
+    return artifacts
+
+
+def collect_dom_snapshot(driver):
+    """CTA候補・フォーム項目・テキストブロックの位置・色・表示状態を1往復で取得する"""
+    return json.loads(driver.execute_script(DOM_SNAPSHOT_SCRIPT))
+
+
+def _capture_full_page(driver, device_type, default_user_agent):
+    """読み込み済みのページのフルページスクリーンショットを取得する
+
+    ウィンドウやエミュレーションの高さはページの高さまで広げない（vh単位のレイアウトが
+    組み直され、DOMスナップショットの座標と画像の位置がずれるため）。
+    """
+    if device_type == "mobile":
+        width, height = DEVICE_PROFILES["mobile"]["window_size"]
+        user_agent = DEVICE_PROFILES["mobile"]["user_agent"]
+        driver.execute_cdp_cmd("Network.setUserAgentOverride", {"userAgent": user_agent})
+        metrics = {"width": width, "height": height, "deviceScaleFactor": 1, "mobile": True}
+        driver.execute_cdp_cmd("Emulation.setDeviceMetricsOverride", metrics)
+        try:
+            # メディアクエリによる再レイアウトを待つ
+            time.sleep(0.5)
+            return _capture_beyond_viewport(driver)
+        finally:
+            driver.execute_cdp_cmd("Emulation.clearDeviceMetricsOverride", {})
+            driver.execute_cdp_cmd("Network.setUserAgentOverride", {"userAgent": default_user_agent})
+
+    return _capture_beyond_viewport(driver)
+
+
+def _capture_beyond_viewport(driver):
+    """ビューポートの大きさを変えずに、ドキュメント全体をCDPで撮影する"""
+    layout = driver.execute_cdp_cmd("Page.getLayoutMetrics", {})
+    content = layout.get("cssContentSize") or layout["contentSize"]
+    screenshot = driver.execute_cdp_cmd("Page.captureScreenshot", {
+        "format": "png",
+        "captureBeyondViewport": True,
+        "clip": {"x": 0, "y": 0, "width": content["width"], "height": content["height"], "scale": 1}
+    })
+    return base64.b64decode(screenshot["data"])
+
+
+def save_screenshot(url, device_type, png):
+    """スクリーンショットを保存し、ファイルパスを返す
+
+    ファイル名は画像内容のハッシュなので、同じ画像は1回しか保存されない。
+    """
+    return get_screenshot_store().save(png, url, device_type)
+
+
+# URL文字列からファイル名に適した文字列を生成する補助関数
+def url_to_filename(url):
+    """URLからファイル名として使える文字列を生成"""
+    # httpやhttpsなどのプロトコル部分を除去
+    url = url.replace("http://", "").replace("https://", "")
+    # 特殊文字を置換
+    url = url.replace("/", "_").replace(".", "-").replace(":", "_").replace("?", "_").replace("&", "_")
+    return url
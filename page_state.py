@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+DEFAULT_STATE_PATH = os.path.join(os.path.dirname(__file__), "data", "page_state.sqlite3")
+
+# 指紋に含めない要素と、リクエストごとに値が変わりやすい属性
+IGNORED_TAGS = ("script", "style", "noscript", "template", "svg")
+VOLATILE_ATTRIBUTES = ("nonce", "integrity", "csrf-token", "data-csrf", "data-nonce", "data-timestamp")
+
+
+def dom_fingerprint(document):
+    """レンダリング後のDOMを正規化したハッシュ
+
+    スクリプト・スタイル・コメント・空白の違いや、nonceなど毎回変わる属性は無視する。
+    """
+    from bs4 import NavigableString, Tag
+
+    digest = hashlib.sha256()
+    # 文書順を保つため、子要素を逆順に積んで深さ優先でたどる
+    stack = [document.soup]
+    while stack:
+        node = stack.pop()
+        if type(node) is NavigableString:
+            normalized = " ".join(node.split())
+            if normalized:
+                digest.update(normalized.encode("utf-8"))
+            continue
+        if not isinstance(node, Tag) or node.name in IGNORED_TAGS:
+            # コメントやDOCTYPEなど
+            continue
+
+        attributes = sorted(
+            (key, " ".join(value) if isinstance(value, list) else str(value))
+            for key, value in node.attrs.items()
+            if key.lower() not in VOLATILE_ATTRIBUTES
+        )
+        digest.update(f"<{node.name} {attributes}>".encode("utf-8"))
+        stack.extend(reversed(node.contents))
+    return digest.hexdigest()
+
+
+def content_fingerprint(document):
+    """テキスト分析の入力になる特徴（タイトル・説明・見出し・CTA・フォーム数）のハッシュ"""
+    features = {
+        "title": document.title,
+        "description": document.description,
+        "headings": document.heading_texts(("h1", "h2", "h3"))[:10],
+        "ctas": document.cta_texts(("a",))[:10],
+        "forms": len(document.forms)
+    }
+    return stable_hash(features)
+
+
+def stable_hash(value):
+    """JSONに変換できる値のハッシュ（キーの順序に依存しない）"""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class PageStateStore:
+    """URLごとの前回の分析状態（HTTP検証子・DOM指紋・ステージ出力・結果）を保存する"""
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv("CVR_PAGE_STATE_PATH", DEFAULT_STATE_PATH)
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def get(self, url):
+        """前回の状態を返す。なければNone"""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT etag, last_modified, fingerprint, stages_json, result_json, updated_at "
+                "FROM page_state WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "etag": row[0],
+            "last_modified": row[1],
+            "fingerprint": row[2],
+            "stages": json.loads(row[3]),
+            "result": json.loads(row[4]),
+            "updated_at": row[5]
+        }
+
+    def save(self, url, etag, last_modified, fingerprint, stages, result):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO page_state "
+                "(url, etag, last_modified, fingerprint, stages_json, result_json, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, fingerprint,
+                 json.dumps(stages, ensure_ascii=False), json.dumps(result, ensure_ascii=False), time.time())
+            )
+            conn.commit()
+
+    def update_validators(self, url, etag, last_modified):
+        """結果を再利用したときに、新しい検証子だけを更新する"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "UPDATE page_state SET etag = ?, last_modified = ? WHERE url = ?", (etag, last_modified, url)
+            )
+            conn.commit()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS page_state ("
+                "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, fingerprint TEXT, "
+                "stages_json TEXT, result_json TEXT, updated_at REAL)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
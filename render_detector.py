@@ -0,0 +1,67 @@
+import os
+import re
+from collections import namedtuple
+
+# クライアントサイドのフレームワークがマウントする代表的なルート要素
+SPA_ROOT_IDS = ("root", "app", "__next", "__nuxt", "___gatsby", "svelte", "q-app")
+SPA_ROOT_ATTRIBUTES = ("data-reactroot", "ng-app", "ng-version", "data-v-app", "data-server-rendered")
+# noscript の案内文によく含まれる語句
+NOSCRIPT_PATTERN = re.compile(r"javascript|enable|有効|必要", re.IGNORECASE)
+# 本文のテキストがこれより短いページは、クライアントサイドで描画されているとみなす
+MIN_BODY_TEXT_LENGTH = 50
+
+# full: 常にブラウザで読み込む / auto: 必要なときだけ読み込む / text: ブラウザを使わない
+RENDER_MODES = ("full", "auto", "text")
+
+RenderDecision = namedtuple("RenderDecision", ["needs_render", "reasons"])
+
+
+def resolve_render_mode(mode=None):
+    """レンダリングモードを返す（省略時は環境変数 CVR_RENDER_MODE、既定は full）"""
+    mode = mode or os.getenv("CVR_RENDER_MODE", "full")
+    if mode not in RENDER_MODES:
+        raise ValueError(f"不明なレンダリングモードです: {mode}")
+    return mode
+
+
+def should_render(mode, document):
+    """モードと静的なHTMLから、ブラウザで読み込むかどうかを決める"""
+    if mode == "full":
+        return RenderDecision(True, ["常にレンダリングするモード"])
+    if mode == "text":
+        return RenderDecision(False, ["テキストのみのモード"])
+    return detect_rendering(document)
+
+
+def detect_rendering(document, min_text_length=MIN_BODY_TEXT_LENGTH):
+    """静的なHTMLだけで分析できるか、ブラウザでのレンダリングが必要かを判定する
+
+    document は生のHTMLを解析した DocumentIndex。空のSPAルート要素・本文の少なさ・
+    JavaScriptを求める noscript のいずれかがあればレンダリングが必要と判定する。
+    """
+    from bs4 import NavigableString
+
+    soup = document.soup
+    body = soup.body or soup
+    reasons = []
+
+    for element in body.find_all(True, limit=50):
+        element_id = element.get("id")
+        is_root = element_id in SPA_ROOT_IDS or any(attr in element.attrs for attr in SPA_ROOT_ATTRIBUTES)
+        if is_root and not element.get_text(strip=True):
+            reasons.append(f"空のSPAルート要素: <{element.name} id=\"{element_id or ''}\">")
+            break
+
+    noscript_text = " ".join(noscript.get_text(" ", strip=True) for noscript in body.find_all("noscript"))
+    if noscript_text and NOSCRIPT_PATTERN.search(noscript_text):
+        reasons.append("JavaScriptの有効化を求めるnoscript")
+
+    text_length = sum(
+        len(text.strip()) for text in body.find_all(string=True)
+        # コメントやCDATAは NavigableString のサブクラスなので除く
+        if type(text) is NavigableString and text.parent.name not in ("script", "style", "noscript", "template")
+    )
+    if text_length < min_text_length:
+        reasons.append(f"本文のテキストが少ない（{text_length}文字）")
+
+    return RenderDecision(bool(reasons), reasons)
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from url_utils import normalize_url
+
+DEFAULT_RESULT_PATH = os.path.join(os.path.dirname(__file__), "data", "results.sqlite3")
+
+
+class ResultStore:
+    """分析結果を保存し、ID・URLごとの履歴で参照できるようにするストア
+
+    URLは正規化してから索引に載せるので、末尾のスラッシュやクエリの順序が違っても
+    同じページの履歴としてまとまる。
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv("CVR_RESULT_STORE_PATH", DEFAULT_RESULT_PATH)
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def save(self, url, result):
+        """結果を保存してIDを返す"""
+        result_id = uuid.uuid4().hex
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT INTO results (id, url, normalized_url, created_at, overall_score, result_json) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (result_id, url, normalize_url(url), time.time(), result.get("overall_score"),
+                 json.dumps(result, ensure_ascii=False))
+            )
+            conn.executemany(
+                "INSERT INTO result_screenshots (result_id, filename) VALUES (?, ?)",
+                [(result_id, filename) for filename in _screenshot_filenames(result)]
+            )
+            conn.commit()
+        return result_id
+
+    def get(self, result_id):
+        """IDで結果を返す。なければNone"""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT id, url, created_at, result_json FROM results WHERE id = ?", (result_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"id": row[0], "url": row[1], "created_at": row[2], "result": json.loads(row[3])}
+
+    def history(self, url, limit=20, offset=0):
+        """URLの分析履歴を新しい順に返す（結果本体は含めず、スコアだけ）"""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT id, url, created_at, overall_score, result_json FROM results "
+                "WHERE normalized_url = ? ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                (normalize_url(url), limit, offset)
+            ).fetchall()
+        return [
+            {
+                "id": result_id,
+                "url": stored_url,
+                "created_at": created_at,
+                "overall_score": overall_score,
+                "category_scores": json.loads(result_json).get("category_scores", {})
+            }
+            for result_id, stored_url, created_at, overall_score, result_json in rows
+        ]
+
+    def referenced_screenshots(self):
+        """保存済みの結果が参照しているスクリーンショットのファイル名"""
+        with self._lock:
+            rows = self._connect().execute("SELECT DISTINCT filename FROM result_screenshots").fetchall()
+        return {row[0] for row in rows}
+
+    def diff(self, base_id, target_id):
+        """2回の分析の総合スコアとカテゴリ別スコアの差分を返す。どちらかがなければNone"""
+        base = self.get(base_id)
+        target = self.get(target_id)
+        if base is None or target is None:
+            return None
+
+        base_scores = base["result"].get("category_scores", {})
+        target_scores = target["result"].get("category_scores", {})
+        categories = {}
+        for category in list(base_scores) + [c for c in target_scores if c not in base_scores]:
+            categories[category] = _score_change(base_scores.get(category), target_scores.get(category))
+
+        return {
+            "base": {"id": base["id"], "url": base["url"], "created_at": base["created_at"]},
+            "target": {"id": target["id"], "url": target["url"], "created_at": target["created_at"]},
+            "overall_score": _score_change(base["result"].get("overall_score"), target["result"].get("overall_score")),
+            "category_scores": categories
+        }
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "id TEXT PRIMARY KEY, url TEXT, normalized_url TEXT, created_at REAL, "
+                "overall_score REAL, result_json TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_results_url ON results (normalized_url, created_at)")
+            # 結果が参照するスクリーンショット（保持期限による削除から外す）
+            conn.execute("CREATE TABLE IF NOT EXISTS result_screenshots (result_id TEXT, filename TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_result_screenshots_filename ON result_screenshots (filename)")
+            if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+                # 参照の記録を始める前に保存された結果の分を一度だけ登録する
+                conn.executemany(
+                    "INSERT INTO result_screenshots (result_id, filename) VALUES (?, ?)",
+                    [(result_id, filename)
+                     for result_id, result_json in conn.execute("SELECT id, result_json FROM results").fetchall()
+                     for filename in _screenshot_filenames(json.loads(result_json))]
+                )
+                conn.execute("PRAGMA user_version = 1")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+
+def _screenshot_filenames(result):
+    return {os.path.basename(path) for path in (result.get("screenshots") or {}).values() if path}
+
+
+def _score_change(before, after):
+    delta = None
+    if isinstance(before, (int, float)) and isinstance(after, (int, float)):
+        delta = round(after - before, 2)
+    return {"base": before, "target": after, "delta": delta}
@@ -1,24 +1,43 @@
 import re
-import requests
-from bs4 import BeautifulSoup
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
 import time
-import json
 import os
-import colormath
-from colormath.color_objects import sRGBColor, LabColor
-from colormath.color_conversions import convert_color
-from colormath.color_diff import delta_e_cie2000
-import urllib.parse
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from metrics import RULE_DURATION
+from page_loader import fetch_html, render_page, static_page
+from render_detector import resolve_render_mode, should_render
+from rule_registry import RuleLoader, rule
+import tracing
+
+# data/rules.json がない場合のデフォルトルール
+DEFAULT_RULES = {
+    "CTA": {
+        "CTA-1": {"name": "CTAボタンのコントラスト比", "max_score": 10, "threshold": 4.5},
+        "CTA-2": {"name": "ファーストビュー内のCTA存在", "max_score": 15, "enabled": True},
+        # 他のCTAルール...
+    },
+    "FORM": {
+        "FORM-1": {"name": "フォーム項目数", "max_score": 10, "ideal_count": 5},
+        # 他のフォームルール...
+    },
+    # 他のカテゴリ...
+}
 
 class CVRRuleChecker:
-    def __init__(self):
-        self.rules = self.load_rules()
+    def __init__(self, max_workers=None):
         self.logger = self.setup_logger()
+        # ルールは読み込み時に1回だけ検証・コンパイルし、rules.json が更新されたら読み直す
+        rules_path = os.path.join(os.path.dirname(__file__), 'data', 'rules.json')
+        self.rule_loader = RuleLoader(rules_path, DEFAULT_RULES, owner=self)
+        self.rule_loader.get()
+        # HTMLだけで評価できるルールを並行実行するワーカー
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or int(os.getenv("CVR_RULE_WORKERS", "4")),
+            thread_name_prefix="rule")
+
+    @property
+    def rules(self):
+        return self.rule_loader.get().config
 
     def setup_logger(self):
         logger = logging.getLogger('cvr_rule_checker')
@@ -30,118 +49,152 @@ class CVRRuleChecker:
         return logger
 
     def load_rules(self):
-        """ルール設定をJSONから読み込む"""
-        rules_path = os.path.join(os.path.dirname(__file__), 'data', 'rules.json')
-        if os.path.exists(rules_path):
-            with open(rules_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        else:
-            # デフォルトルールを返す（ここでは例としていくつかの項目を設定）
-            return {
-                "CTA": {
-                    "CTA-1": {"name": "CTAボタンのコントラスト比", "max_score": 10, "threshold": 4.5},
-                    "CTA-2": {"name": "ファーストビュー内のCTA存在", "max_score": 15, "enabled": True},
-                    # 他のCTAルール...
-                },
-                "FORM": {
-                    "FORM-1": {"name": "フォーム項目数", "max_score": 10, "ideal_count": 5},
-                    # 他のフォームルール...
-                },
-                # 他のカテゴリ...
-            }
+        """ルール設定を返す（data/rules.json があればその内容、なければデフォルトルール）"""
+        return self.rule_loader.get().config
 
-    def check_url(self, url):
-        """URLに対してすべてのルールをチェック"""
-        self.logger.info(f"URLのルールチェック開始: {url}")
+    def check_url(self, url, page=None, render_mode=None, trace=None):
+        """URLに対してすべてのルールをチェック
 
-        # Seleniumセットアップ
-        options = Options()
-        options.add_argument("--headless")
-        options.add_argument("--window-size=1920,1080")
-        service = Service(ChromeDriverManager().install())
-        driver = webdriver.Chrome(service=service, options=options)
+        page に読み込み済みの PageArtifacts を渡した場合は、ページを再読み込みせずにそれを評価する。
+        render_mode が "auto" / "text" の場合、ブラウザが不要なページ（"text" では常に）は
+        静的なHTMLだけで評価できるルールのみを実行する。
+        trace=True なら処理の内訳をトレースとして data/traces に書き出す（省略時は CVR_TRACE）。
+        """
+        with tracing.start_trace("check_url", trace, url=url):
+            return self._check_url(url, page, render_mode)
 
-        try:
-            # ページの読み込み
-            driver.get(url)
-            time.sleep(3)  # ページが完全に読み込まれるまで待機
+    def _check_url(self, url, page, render_mode):
+        self.logger.info(f"URLのルールチェック開始: {url}")
 
-            # HTMLコンテンツの取得
-            html_content = driver.page_source
-            soup = BeautifulSoup(html_content, 'html.parser')
+        try:
+            rule_set = self.rule_loader.get()
+            if page is not None:
+                # ブラウザを使わずに読み込んだページ（static_page）ではブラウザを使うルールを実行しない
+                return self.check_page(page, rule_set, static_only=page.dom_snapshot is None)
+
+            render_mode = resolve_render_mode(render_mode)
+            if render_mode != "full":
+                page = static_page(url, fetch_html(url))
+                decision = should_render(render_mode, page.document)
+                if not decision.needs_render:
+                    return self.check_page(page, rule_set, static_only=True)
+                self.logger.info(f"ブラウザでレンダリングします: {', '.join(decision.reasons)}")
+
+            # ページを1回だけ読み込み、ブラウザを使うルールはすべて同じセッションで評価する
+            devices = ("desktop",) if rule_set.requires("screenshot") else ()
+            with render_page(url, devices=devices, keep_driver=rule_set.requires("driver")) as page:
+                return self.check_page(page, rule_set)
 
-            # 結果を格納する辞書
-            results = {
+        except Exception as e:
+            self.logger.error(f"ルールチェックエラー: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            return {
                 "url": url,
                 "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "error": str(e),
                 "categories": {},
                 "total_score": 0,
                 "max_possible_score": 0,
                 "percentage": 0
             }
 
-            # カテゴリごとにルールチェック
-            for category, rules in self.rules.items():
-                category_results = {
-                    "rules": {},
-                    "score": 0,
-                    "max_score": 0,
-                    "percentage": 0
-                }
+    def check_page(self, page, rule_set=None, static_only=False):
+        """読み込み済みのページ成果物に対してすべてのルールをチェック
+
+        HTMLだけで評価できるルールはワーカーで並行して実行し、
+        ブラウザを使うルールは呼び出し元のスレッドで順に実行する（同じページ・セッションを共有する）。
+        static_only=True の場合はブラウザを使うルールを実行しない。
+        """
+        url = page.url
+        rule_set = rule_set or self.rule_loader.get()
+        rules = [compiled for compiled in rule_set.rules if not static_only or compiled.requires == "static"]
+        # 解析済みの索引をすべてのルールで共有する
+        document = page.document
+
+        # 結果を格納する辞書
+        results = {
+            "url": url,
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "categories": {},
+            "total_score": 0,
+            "max_possible_score": 0,
+            "percentage": 0,
+            "render_mode": "text" if static_only else "full"
+        }
+
+        futures = {
+            compiled.rule_id: self.executor.submit(tracing.wrap(self._run_rule), compiled, page, document)
+            for compiled in rules if compiled.requires == "static"
+        }
+        rule_results = {
+            compiled.rule_id: self._run_rule(compiled, page, document)
+            for compiled in rules if compiled.requires != "static"
+        }
+        rule_results.update({rule_id: future.result() for rule_id, future in futures.items()})
+
+        # カテゴリごとにルールの結果を集計（順序は設定の順）
+        for category in rule_set.config:
+            category_results = {
+                "rules": {},
+                "score": 0,
+                "max_score": 0,
+                "percentage": 0
+            }
 
-                for rule_id, rule_config in rules.items():
-                    if rule_config.get("enabled", True):
-                        # ルールメソッドの動的呼び出し
-                        method_name = f"check_{rule_id.lower().replace('-', '_')}"
-                        if hasattr(self, method_name):
-                            rule_method = getattr(self, method_name)
-                            result = rule_method(driver, soup, rule_config)
-
-                            category_results["rules"][rule_id] = result
-                            category_results["score"] += result["score"]
-                            category_results["max_score"] += rule_config["max_score"]
-
-                # カテゴリのパーセンテージを計算
-                if category_results["max_score"] > 0:
-                    category_results["percentage"] = round(
-                        (category_results["score"] / category_results["max_score"]) * 100, 1
-                    )
-
-                results["categories"][category] = category_results
-                results["total_score"] += category_results["score"]
-                results["max_possible_score"] += category_results["max_score"]
-
-            # 総合パーセンテージを計算
-            if results["max_possible_score"] > 0:
-                results["percentage"] = round(
-                    (results["total_score"] / results["max_possible_score"]) * 100, 1
+            for compiled in rules:
+                if compiled.category != category:
+                    continue
+                result = rule_results[compiled.rule_id]
+                category_results["rules"][compiled.rule_id] = result
+                category_results["score"] += result["score"]
+                category_results["max_score"] += compiled.config["max_score"]
+
+            # カテゴリのパーセンテージを計算
+            if category_results["max_score"] > 0:
+                category_results["percentage"] = round(
+                    (category_results["score"] / category_results["max_score"]) * 100, 1
                 )
 
-            self.logger.info(f"ルールチェック完了: スコア {results['total_score']}/{results['max_possible_score']} ({results['percentage']}%)")
-            return results
+            results["categories"][category] = category_results
+            results["total_score"] += category_results["score"]
+            results["max_possible_score"] += category_results["max_score"]
+
+        # 総合パーセンテージを計算
+        if results["max_possible_score"] > 0:
+            results["percentage"] = round(
+                (results["total_score"] / results["max_possible_score"]) * 100, 1
+            )
 
+        self.logger.info(f"ルールチェック完了: スコア {results['total_score']}/{results['max_possible_score']} ({results['percentage']}%)")
+        return results
+
+    def _run_rule(self, compiled, page, document):
+        """ルールを1つ実行し、実行時間（ミリ秒）を結果に記録する"""
+        start = time.perf_counter()
+        try:
+            with tracing.span(f"rule {compiled.rule_id}"):
+                result = compiled.func(page, document, compiled.config)
         except Exception as e:
-            self.logger.error(f"ルールチェックエラー: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            return {
-                "url": url,
-                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-                "error": str(e),
-                "categories": {},
-                "total_score": 0,
-                "max_possible_score": 0,
-                "percentage": 0
+            self.logger.error(f"{compiled.rule_id}チェックエラー: {str(e)}")
+            result = {
+                "name": compiled.config["name"],
+                "score": 0,
+                "max_score": compiled.config["max_score"],
+                "details": f"エラー: {str(e)}"
             }
-        finally:
-            driver.quit()
+        elapsed = time.perf_counter() - start
+        RULE_DURATION.labels(rule=compiled.rule_id).observe(elapsed)
+        result["elapsed_ms"] = round(elapsed * 1000, 2)
+        return result
 
     # 以下、個別ルールのチェックメソッド
-    def check_cta_1(self, driver, soup, rule_config):
+    @rule("CTA-1", requires="screenshot")
+    def check_cta_1(self, page, document, rule_config):
         """CTAボタンのコントラスト比をチェック"""
         try:
-            # CTAボタンを特定（class名に'btn'や'button'を含む要素）
-            cta_elements = soup.find_all(['a', 'button'], class_=lambda c: c and ('btn' in c.lower() or 'button' in c.lower() or 'cta' in c.lower()))
+            # ブラウザで取得したスナップショットから表示されているCTAを取り出す
+            cta_elements = [cta for cta in page.dom_snapshot["ctas"] if cta["visible"]]
 
             if not cta_elements:
                 return {
@@ -151,31 +204,29 @@ class CVRRuleChecker:
                     "details": "CTAボタンが見つかりません"
                 }
 
-            # 最高コントラスト比を初期化
-            best_contrast = 0
-
-            for cta in cta_elements:
-                # JSを実行してボタンの色と背景色を取得
-                script = """
-                function getColors(element) {
-                    const style = window.getComputedStyle(element);
-                    const bgColor = style.backgroundColor;
-                    const textColor = style.color;
-                    return [bgColor, textColor];
-                }
-                return getColors(arguments[0]);
-                """
-                colors = driver.execute_script(script, driver.find_element_by_xpath(f"//*[text()='{cta.text}']"))
-
-                # RGB値を抽出（形式: 'rgb(r, g, b)' または 'rgba(r, g, b, a)'）
-                bg_color = self.parse_rgb(colors[0])
-                text_color = self.parse_rgb(colors[1])
-
-                if bg_color and text_color:
-                    # コントラスト比の計算
-                    contrast = self.calculate_contrast(bg_color, text_color)
-                    if contrast > best_contrast:
-                        best_contrast = contrast
+            # スクリーンショットの実際の画素からコントラスト比を測る
+            # （背景画像やグラデーション、半透明の重なりも反映される）
+            # numpy・Pillowはブラウザを使うルールを実行するときまで読み込まない
+            from contrast import measure_page_contrast
+            measured = measure_page_contrast(page)
+            ratios = []
+            method = "screenshot"
+            if measured is not None:
+                ratios = [cta["contrast"]["ratio"] for cta in measured["ctas"] if cta["contrast"]]
+
+            if not ratios:
+                # スクリーンショットがない場合は、計算済みスタイルの色で評価する
+                # 背景が透明なボタンは、色の付いた祖先要素の背景色で評価する
+                for cta in cta_elements:
+                    # RGB値を抽出（形式: 'rgb(r, g, b)' または 'rgba(r, g, b, a)'）
+                    bg_color = self.parse_rgb(cta["effective_background_color"])
+                    text_color = self.parse_rgb(cta["color"])
+                    if bg_color and text_color:
+                        ratios.append(self.calculate_contrast(bg_color, text_color))
+                method = "computed_style"
+
+            # 最高コントラスト比
+            best_contrast = max(ratios, default=0)
 
             # スコアの計算
             threshold = rule_config.get("threshold", 4.5)
@@ -192,7 +243,8 @@ class CVRRuleChecker:
                 "score": score,
                 "max_score": rule_config["max_score"],
                 "details": details,
-                "contrast_ratio": best_contrast
+                "contrast_ratio": best_contrast,
+                "method": method
             }
 
         except Exception as e:
@@ -216,29 +268,18 @@ class CVRRuleChecker:
 
     def calculate_contrast(self, color1, color2):
         """2色間のコントラスト比を計算"""
-        # L*値の計算（輝度）
-        def calculate_luminance(rgb):
-            rgb_normalized = [c/255 for c in rgb]
-            rgb_linear = [c/12.92 if c <= 0.03928 else ((c+0.055)/1.055)**2.4 for c in rgb_normalized]
-            return 0.2126 * rgb_linear[0] + 0.7152 * rgb_linear[1] + 0.0722 * rgb_linear[2]
-
-        l1 = calculate_luminance(color1)
-        l2 = calculate_luminance(color2)
-
-        # 明るい色/暗い色の比率
-        if l1 > l2:
-            return (l1 + 0.05) / (l2 + 0.05)
-        else:
-            return (l2 + 0.05) / (l1 + 0.05)
-
-    def check_cta_2(self, driver, soup, rule_config):
+        from contrast import color_contrast
+        return color_contrast(color1, color2)
+
+    @rule("CTA-2", requires="snapshot")
+    def check_cta_2(self, page, document, rule_config):
         """ファーストビュー内のCTA存在をチェック"""
         try:
             # ページの高さを取得
-            viewport_height = driver.execute_script("return window.innerHeight")
+            viewport_height = page.dom_snapshot["viewport"]["height"]
 
             # CTAボタンを特定
-            cta_elements = soup.find_all(['a', 'button'], class_=lambda c: c and ('btn' in c.lower() or 'button' in c.lower() or 'cta' in c.lower()))
+            cta_elements = [cta for cta in page.dom_snapshot["ctas"] if cta["visible"]]
 
             if not cta_elements:
                 return {
@@ -248,21 +289,8 @@ class CVRRuleChecker:
                     "details": "CTAボタンが見つかりません"
                 }
 
-            # CTAの位置をチェック
-            cta_in_viewport = False
-
-            for cta in cta_elements:
-                # 要素の位置を取得
-                try:
-                    element = driver.find_element_by_xpath(f"//*[contains(text(), '{cta.text.strip()}')]")
-                    location = element.location['y']
-
-                    # ビューポート内にあるかチェック
-                    if location <= viewport_height:
-                        cta_in_viewport = True
-                        break
-                except:
-                    continue
+            # CTAの位置をチェック（要素の上端がビューポート内にあるか）
+            cta_in_viewport = any(cta["bbox"]["y"] <= viewport_height for cta in cta_elements)
 
             if cta_in_viewport:
                 return {
@@ -290,11 +318,12 @@ class CVRRuleChecker:
 
     # 他のチェックメソッドも同様に実装...
     # 例えば:
-    def check_form_1(self, driver, soup, rule_config):
+    @rule("FORM-1", requires="static")
+    def check_form_1(self, page, document, rule_config):
         """フォーム項目数をチェック"""
         try:
             # フォーム要素を検索
-            forms = soup.find_all('form')
+            forms = document.forms
 
             if not forms:
                 return {
@@ -305,11 +334,9 @@ class CVRRuleChecker:
                 }
 
             # 最も入力項目の少ないフォームを評価対象とする
+            # （索引の入力項目はtype="hidden"や"submit"を除外済み）
             min_fields = float('inf')
-            for form in forms:
-                input_fields = form.find_all(['input', 'textarea', 'select'])
-                # type="hidden"や"submit"は除外
-                visible_fields = [f for f in input_fields if f.get('type') not in ['hidden', 'submit', 'button']]
+            for visible_fields in document.form_fields:
                 if len(visible_fields) < min_fields and len(visible_fields) > 0:
                     min_fields = len(visible_fields)
 
@@ -0,0 +1,156 @@
+import os
+import json
+import threading
+from collections import namedtuple
+
+# ルールが評価に必要とするもの
+#   static     : 解析済みのHTML（DocumentIndex）だけ
+#   snapshot   : ブラウザでレンダリングしたページのDOMスナップショット（要素の位置・色・表示状態）
+#   screenshot : ブラウザで撮影したスクリーンショット（とDOMスナップショット）
+#   driver     : ページを開いたままのドライバー（page.driver を操作するルールだけが指定する）
+REQUIREMENTS = ("static", "snapshot", "screenshot", "driver")
+
+# rules.json の各ルール設定で型を確認するキー（値は許可する型）
+RULE_CONFIG_SCHEMA = {
+    "name": (str,),
+    "max_score": (int, float),
+    "enabled": (bool,),
+    "threshold": (int, float),
+    "ideal_count": (int,)
+}
+REQUIRED_RULE_KEYS = ("name", "max_score")
+
+RuleSpec = namedtuple("RuleSpec", ["rule_id", "func", "requires"])
+CompiledRule = namedtuple("CompiledRule", ["category", "rule_id", "config", "func", "requires"])
+
+
+class RuleConfigError(ValueError):
+    """rules.json の内容がスキーマに合わない"""
+
+
+_registry = {}
+
+
+def rule(rule_id, requires="static"):
+    """ルールのチェック関数を登録するデコレーター
+
+    requires には評価に必要なもの（REQUIREMENTS のいずれか）を指定する。
+    """
+    if requires not in REQUIREMENTS:
+        raise ValueError(f"不明な要件です: {requires}")
+
+    def decorator(func):
+        _registry[rule_id] = RuleSpec(rule_id, func, requires)
+        return func
+    return decorator
+
+
+def validate_rules(config):
+    """ルール設定をスキーマに照らして検証する。問題があれば RuleConfigError を送出する"""
+    errors = []
+    if not isinstance(config, dict):
+        raise RuleConfigError("ルール設定はカテゴリをキーとするオブジェクトである必要があります")
+
+    for category, rules in config.items():
+        if not isinstance(rules, dict):
+            errors.append(f"{category}: ルールIDをキーとするオブジェクトである必要があります")
+            continue
+        for rule_id, rule_config in rules.items():
+            if not isinstance(rule_config, dict):
+                errors.append(f"{category}.{rule_id}: 設定はオブジェクトである必要があります")
+                continue
+            for key in REQUIRED_RULE_KEYS:
+                if key not in rule_config:
+                    errors.append(f"{category}.{rule_id}: {key} がありません")
+            for key, types in RULE_CONFIG_SCHEMA.items():
+                value = rule_config.get(key)
+                # boolはintのサブクラスなので、数値のキーでは明示的に除外する
+                if key in rule_config and (not isinstance(value, types) or
+                                           (bool not in types and isinstance(value, bool))):
+                    errors.append(f"{category}.{rule_id}: {key} の型が正しくありません")
+            if isinstance(rule_config.get("max_score"), (int, float)) and rule_config["max_score"] < 0:
+                errors.append(f"{category}.{rule_id}: max_score は0以上である必要があります")
+
+    if errors:
+        raise RuleConfigError("ルール設定が不正です: " + "; ".join(errors))
+
+
+def compile_rules(config, owner=None):
+    """ルール設定を検証し、有効なルールをチェック関数と結び付けたリストにする
+
+    owner を渡すと、登録された関数をそのインスタンスのメソッドとして結び付ける。
+    未実装のルールIDは読み飛ばす。
+    """
+    validate_rules(config)
+
+    compiled = []
+    for category, rules in config.items():
+        for rule_id, rule_config in rules.items():
+            if not rule_config.get("enabled", True):
+                continue
+            spec = _registry.get(rule_id)
+            if spec is None:
+                print(f"未実装のルールを読み飛ばします: {rule_id}")
+                continue
+            func = spec.func.__get__(owner) if owner is not None else spec.func
+            compiled.append(CompiledRule(category, rule_id, rule_config, func, spec.requires))
+    return compiled
+
+
+class RuleSet:
+    """コンパイル済みのルール一式と、その元になった設定"""
+
+    def __init__(self, config, rules, mtime=None):
+        self.config = config
+        self.rules = rules
+        self.mtime = mtime
+
+    def requires(self, requirement):
+        return any(compiled.requires == requirement for compiled in self.rules)
+
+
+class RuleLoader:
+    """rules.json を読み込んでコンパイルし、ファイルが更新されたら読み込み直す
+
+    ファイルがなければ default_config を使う。更新後の内容が不正な場合は、
+    エラーを表示して直前のルール一式を使い続ける。
+    """
+
+    def __init__(self, path, default_config, owner=None):
+        self.path = path
+        self.default_config = default_config
+        self.owner = owner
+        self._lock = threading.Lock()
+        self._rule_set = None
+
+    def get(self):
+        """現在のルール一式を返す（ファイルの更新時刻が変わっていれば再コンパイルする）"""
+        mtime = self._mtime()
+        with self._lock:
+            if self._rule_set is None or self._rule_set.mtime != mtime:
+                try:
+                    self._rule_set = self._compile(mtime)
+                except (OSError, ValueError) as e:
+                    if self._rule_set is None:
+                        raise
+                    print(f"ルール設定の再読み込みに失敗しました（前回の設定を使用します）: {str(e)}")
+                    # 同じ内容で毎回読み直さないよう、更新時刻だけ進める
+                    self._rule_set.mtime = mtime
+            return self._rule_set
+
+    def _compile(self, mtime):
+        if mtime is None:
+            config = self.default_config
+        else:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        rule_set = RuleSet(config, compile_rules(config, self.owner), mtime)
+        if mtime is not None:
+            print(f"ルール設定を読み込みました: {self.path}（{len(rule_set.rules)}件）")
+        return rule_set
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
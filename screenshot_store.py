@@ -0,0 +1,205 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from result_store import ResultStore
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 画像はstatic配下に置き、テンプレートからは "static/screenshots/<hash>.png" で参照する
+SCREENSHOT_URL_DIR = "static/screenshots"
+DEFAULT_INDEX_PATH = os.path.join(BASE_DIR, "data", "screenshots.sqlite3")
+
+
+class ScreenshotStore:
+    """内容のハッシュで名前を付けてスクリーンショットを保存するストア
+
+    同一の画像は1ファイルだけ保存し、撮影ごとのメタデータ（URL・デバイス・撮影時刻）は
+    SQLiteのインデックスに記録する。合計サイズと経過時間による保持期限を
+    バックグラウンドのスレッドで定期的に適用する。
+    retain を渡すと、retain() が返すファイル名の画像（保存済みの分析結果が参照する画像など）は削除しない。
+    """
+
+    def __init__(self, root=None, index_path=None, max_bytes=None, max_age=None, eviction_interval=None,
+                 retain=None):
+        self.root = root or os.getenv("CVR_SCREENSHOT_DIR", os.path.join(BASE_DIR, SCREENSHOT_URL_DIR))
+        self.index_path = index_path or os.getenv("CVR_SCREENSHOT_INDEX_PATH", DEFAULT_INDEX_PATH)
+        self.max_bytes = max_bytes or int(os.getenv("CVR_SCREENSHOT_MAX_MB", "2048")) * 1024 * 1024
+        # 秒単位。0以下なら経過時間では削除しない
+        self.max_age = max_age if max_age is not None else float(os.getenv("CVR_SCREENSHOT_MAX_AGE", str(30 * 24 * 3600)))
+        self.eviction_interval = eviction_interval or float(os.getenv("CVR_SCREENSHOT_EVICT_INTERVAL", "600"))
+        self.retain = retain
+
+        self._lock = threading.Lock()
+        self._conn = None
+        self._evictor = None
+
+    def save(self, png, url, device_type):
+        """画像を保存し、テンプレートから参照するパスを返す。同じ画像が既にあれば再利用する"""
+        digest = hashlib.sha256(png).hexdigest()
+        filename = f"{digest[:32]}.png"
+        path = os.path.join(self.root, filename)
+        now = time.time()
+
+        with self._lock:
+            conn = self._connect()
+            if not os.path.exists(path):
+                os.makedirs(self.root, exist_ok=True)
+                # 書きかけのファイルが配信されないよう、一時ファイルから置き換える
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(png)
+                os.replace(tmp_path, path)
+
+            conn.execute(
+                "INSERT INTO images (digest, filename, size, created_at, last_used_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(digest) DO UPDATE SET last_used_at = excluded.last_used_at",
+                (digest, filename, len(png), now, now)
+            )
+            conn.execute(
+                "INSERT INTO captures (digest, url, device_type, captured_at) VALUES (?, ?, ?, ?)",
+                (digest, url, device_type, now)
+            )
+            conn.commit()
+
+        self._start_evictor()
+        return f"{SCREENSHOT_URL_DIR}/{filename}"
+
+    def file_path(self, path):
+        """save() が返したパス（テンプレート用の相対パス）を、読み込み用の絶対パスにする
+
+        作業ディレクトリによらず同じファイルを開けるよう、ストアのディレクトリを基準にする。
+        それ以外のパスはそのまま返す。
+        """
+        prefix = f"{SCREENSHOT_URL_DIR}/"
+        if path and path.startswith(prefix):
+            return os.path.join(self.root, path[len(prefix):])
+        return path
+
+    def touch(self, paths):
+        """画像を利用したものとして最終利用時刻を更新する（保持期限による削除の対象から外す）
+
+        前回の分析結果を再利用した場合など、撮影し直さずに画像を参照し続けるときに呼ぶ。
+        """
+        filenames = [os.path.basename(path) for path in paths if path]
+        if not filenames:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("UPDATE images SET last_used_at = ? WHERE filename = ?",
+                             [(time.time(), filename) for filename in filenames])
+            conn.commit()
+
+    def captures(self, url, limit=20):
+        """URLの撮影履歴を新しい順に返す"""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT c.device_type, c.captured_at, i.filename FROM captures c "
+                "JOIN images i ON i.digest = c.digest WHERE c.url = ? ORDER BY c.captured_at DESC LIMIT ?",
+                (url, limit)
+            ).fetchall()
+        return [
+            {"device_type": device_type, "captured_at": captured_at, "path": f"{SCREENSHOT_URL_DIR}/{filename}"}
+            for device_type, captured_at, filename in rows
+        ]
+
+    def enforce_retention(self):
+        """期限切れの画像を削除し、合計サイズが上限を超えた分を最終利用が古い順に削除する
+
+        retain() が返すファイル名の画像は、期限切れでもサイズの上限を超えていても削除しない。
+        """
+        now = time.time()
+        retained = set(self.retain()) if self.retain is not None else set()
+        with self._lock:
+            conn = self._connect()
+            expired = []
+            if self.max_age > 0:
+                expired = [
+                    (digest, filename) for digest, filename in conn.execute(
+                        "SELECT digest, filename FROM images WHERE last_used_at < ?", (now - self.max_age,))
+                    if filename not in retained
+                ]
+
+            expired_digests = {digest for digest, _ in expired}
+            remaining = [
+                row for row in conn.execute("SELECT digest, filename, size FROM images ORDER BY last_used_at ASC")
+                if row[0] not in expired_digests
+            ]
+            total = sum(size for _, _, size in remaining)
+
+            over_size = []
+            for digest, filename, size in remaining:
+                if total <= self.max_bytes:
+                    break
+                if filename in retained:
+                    continue
+                over_size.append((digest, filename))
+                total -= size
+
+            removed = expired + over_size
+            for digest, filename in removed:
+                try:
+                    os.remove(os.path.join(self.root, filename))
+                except FileNotFoundError:
+                    pass
+                conn.execute("DELETE FROM captures WHERE digest = ?", (digest,))
+                conn.execute("DELETE FROM images WHERE digest = ?", (digest,))
+            conn.commit()
+
+        if removed:
+            print(f"スクリーンショットを{len(removed)}件削除しました")
+        return len(removed)
+
+    def _start_evictor(self):
+        with self._lock:
+            if self._evictor is not None:
+                return
+            self._evictor = threading.Thread(target=self._evict_loop, name="screenshot-evictor", daemon=True)
+            self._evictor.start()
+
+    def _evict_loop(self):
+        while True:
+            try:
+                self.enforce_retention()
+            except Exception as e:
+                print(f"スクリーンショット削除エラー: {str(e)}")
+            time.sleep(self.eviction_interval)
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.index_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                "digest TEXT PRIMARY KEY, filename TEXT, size INTEGER, created_at REAL, last_used_at REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS captures ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, digest TEXT, url TEXT, device_type TEXT, captured_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_images_last_used ON images (last_used_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_captures_url ON captures (url, captured_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_captures_digest ON captures (digest)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_screenshot_store():
+    """プロセス共有のスクリーンショットストアを返す"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            # 分析結果の履歴（/results/<id>）が参照する画像は削除しない
+            _store = ScreenshotStore(retain=ResultStore().referenced_screenshots)
+        return _store
+
+
+def screenshot_file_path(path):
+    """スクリーンショットのパスを、読み込み用の絶対パスにする（ScreenshotStore.file_path）"""
+    return get_screenshot_store().file_path(path)
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import uuid
+import random
+import threading
+import contextvars
+from contextlib import contextmanager
+
+DEFAULT_TRACE_DIR = os.path.join(os.path.dirname(__file__), "data", "traces")
+
+# 実行中のトレース（トレースしていなければNone）
+_current_trace = contextvars.ContextVar("cvr_trace", default=None)
+
+
+class Trace:
+    """1回の分析（またはルールチェック）で記録したスパンの一覧
+
+    Chromeのtrace event形式（Perfetto・chrome://tracing で読み込める）で書き出す。
+    """
+
+    def __init__(self, name, args=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.args = args or {}
+        self.pid = os.getpid()
+        self.events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def add_span(self, name, start, end, args):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": "cvr",
+            "ph": "X",
+            "ts": round((start - self._origin) * 1e6, 1),
+            "dur": round((end - start) * 1e6, 1),
+            "pid": self.pid,
+            "tid": thread.native_id,
+        }
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.events.append(event)
+            self._threads[thread.native_id] = thread.name
+
+    def to_dict(self):
+        with self._lock:
+            events = list(self.events)
+            threads = dict(self._threads)
+        metadata = [
+            {"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0, "args": {"name": f"{self.name} {self.id}"}}
+        ] + [
+            {"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+            for tid, name in threads.items()
+        ]
+        return {"traceEvents": metadata + events, "displayTimeUnit": "ms", "otherData": self.args}
+
+    def write(self, directory=None):
+        """トレースをJSONファイルに書き出してパスを返す"""
+        directory = directory or os.getenv("CVR_TRACE_DIR", DEFAULT_TRACE_DIR)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}_{self.name}_{self.id}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+        return path
+
+
+class _Span:
+    __slots__ = ("trace", "name", "args", "start")
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.args["error"] = f"{exc_type.__name__}: {exc_value}"
+        self.trace.add_span(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name, **args):
+    """処理の区間を記録するコンテキストマネージャー（トレース中でなければ何もしない）"""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NOOP_SPAN
+    return _Span(trace, name, args)
+
+
+def wrap(func):
+    """別スレッドで実行する関数に、現在のトレースを引き継ぐ
+
+    ThreadPoolExecutor はコンテキスト変数を引き継がないので、submit する関数をこれで包む。
+    トレース中でなければ func をそのまま返す。
+    同じコンテキストには同時に1スレッドしか入れないため、呼び出しごとにコピーしてから実行する
+    （包んだ関数を複数回 submit しても並行して実行できる）。
+    """
+    if _current_trace.get() is None:
+        return func
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+def should_trace(enabled=None):
+    """トレースするかを決める
+
+    enabled を指定すればそれに従う。省略時は環境変数 CVR_TRACE に従う
+    （1: すべて / 0〜1の小数: その割合でサンプリング / 0・未設定: しない）。
+    """
+    if enabled is not None:
+        return bool(enabled)
+    setting = os.getenv("CVR_TRACE", "")
+    if not setting:
+        return False
+    try:
+        rate = float(setting)
+    except ValueError:
+        return setting.lower() in ("true", "yes", "on")
+    return rate >= 1 or random.random() < rate
+
+
+@contextmanager
+def start_trace(name, enabled=None, **args):
+    """トレースを開始し、終了時にファイルへ書き出す
+
+    すでにトレース中の場合は、新しいトレースを作らずに1つのスパンとして記録する。
+    """
+    if _current_trace.get() is not None:
+        with span(name, **args):
+            yield
+        return
+    if not should_trace(enabled):
+        yield
+        return
+
+    trace = Trace(name, args)
+    token = _current_trace.set(trace)
+    try:
+        with _Span(trace, name, dict(args)):
+            yield
+    finally:
+        _current_trace.reset(token)
+        try:
+            print(f"トレースを書き出しました: {trace.write()}")
+        except OSError as e:
+            print(f"トレースの書き出しエラー: {str(e)}")